@@ -7,7 +7,8 @@ __author__ = 'Bruno Renie'
 
 try:
     from fabric.api import env, task
-    from .bundle import deploy, destroy
+    from .bundle import deploy, destroy, rollback
+    from .plan import plan
     from .provisioning import bootstrap
     from .utils import ssh
 except ImportError:
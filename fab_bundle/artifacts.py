@@ -0,0 +1,315 @@
+"""
+Building the package to deploy
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tarfile
+
+from fabric.api import env
+from fabric.context_managers import settings
+from pkg_resources import Requirement, parse_version
+
+from . import transport
+from .timing import TIMELINE_DIR, local, run, put, get
+from .utils import btw
+
+CACHE = os.path.join('dist', '.fab-bundle.json')
+WHEELHOUSE = 'wheelhouse'
+IGNORE_DIRS = set(['.git', '.hg', '.svn', '.tox', 'build', 'dist',
+                   WHEELHOUSE])
+
+# Installed in every bundle next to the project itself
+SERVER_PACKAGES = ['gunicorn', 'gevent', 'greenlet', 'setproctitle']
+
+
+class Artifact(object):
+    """A source distribution in ``dist/``"""
+    def __init__(self, file_name, sha256=None):
+        self.file_name = file_name
+        self.path = os.path.join('dist', file_name)
+        self.name, version = file_name.rsplit('-', 1)
+        self.version = version[:-len('.tar.gz')]
+        self._sha256 = sha256
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = file_checksum(self.path)
+        return self._sha256
+
+    def requirement(self, version=None):
+        return '{0}=={1}'.format(self.name, version or self.version)
+
+    def dependencies(self):
+        """
+        The install requirements declared in the sdist's egg-info, without
+        extras.
+        """
+        with tarfile.open(self.path, 'r:gz') as archive:
+            for member in archive.getmembers():
+                parts = member.name.split('/')
+                if (len(parts) == 3 and parts[1].endswith('.egg-info') and
+                        parts[2] == 'requires.txt'):
+                    requires = archive.extractfile(member).read()
+                    break
+            else:
+                return []
+        dependencies = []
+        for line in requires.decode('utf-8').splitlines():
+            line = line.strip()
+            if line.startswith('['):
+                break  # extras
+            if line:
+                dependencies.append(line)
+        return dependencies
+
+    def schema_checksum(self):
+        """
+        Hashes the models and migrations in the sdist, what syncdb and the
+        migrations depend on.
+        """
+        digest = hashlib.sha256()
+        with tarfile.open(self.path, 'r:gz') as archive:
+            members = sorted(archive.getmembers(), key=lambda m: m.name)
+            for member in members:
+                # Paths are relative to the sdist's top directory
+                parts = member.name.split('/')[1:]
+                if not member.isfile() or member.name.endswith('.pyc'):
+                    continue
+                if not (parts[-1] == 'models.py' or
+                        'models' in parts[:-1] or 'migrations' in parts):
+                    continue
+                digest.update('/'.join(parts).encode('utf-8') + b'\n')
+                digest.update(archive.extractfile(member).read())
+        return digest.hexdigest()
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pinned(dependencies):
+    """Whether each requirement is pinned to a single version with =="""
+    for line in dependencies:
+        specs = Requirement.parse(line).specs
+        if len(specs) != 1 or specs[0][0] not in ('==', '==='):
+            return False
+    return True
+
+
+def fingerprint(dependencies, packages):
+    """
+    Identifies a set of installed dependencies: the requirements, the
+    checksums of the local packages they can be installed from and the way
+    they're installed.
+    """
+    digest = hashlib.sha256()
+    for requirement in sorted(dependencies):
+        digest.update(requirement.encode('utf-8') + b'\n')
+    for name, sha256 in sorted(packages.items()):
+        digest.update('{0} {1}\n'.format(name, sha256).encode('utf-8'))
+    digest.update(repr((env.get('index_url'),
+                        bool(env.get('wheelhouse')))).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def canonical(name):
+    """A project name as pip compares them"""
+    return re.sub(r'[-_.]+', '-', name.strip()).lower()
+
+
+def own_wheels(artifact, names):
+    """The wheels of ``artifact``'s project among ``names``, any version"""
+    project = canonical(artifact.name)
+    return [name for name in names if name.endswith('.whl') and
+            canonical(name.split('-', 1)[0]) == project]
+
+
+def prune_wheels(artifact):
+    """Removes the wheels of the project's earlier versions"""
+    for name in own_wheels(artifact, os.listdir(WHEELHOUSE)):
+        if parse_version(name.split('-')[1]) != parse_version(
+                artifact.version):
+            os.remove(os.path.join(WHEELHOUSE, name))
+
+
+def source_files(root='.'):
+    """
+    The files the sdist is made of, relative to ``root``: the ones tracked
+    by git, or the ones listed by the previous build with setup.py and
+    MANIFEST.in. None when neither is available.
+    """
+    with open(os.devnull, 'w') as devnull:
+        try:
+            process = subprocess.Popen(['git', 'ls-files', '-z'], cwd=root,
+                                       stdout=subprocess.PIPE, stderr=devnull)
+            output = process.communicate()[0]
+        except OSError:  # git isn't installed
+            process = None
+    if process is not None and process.returncode == 0:
+        return sorted(set(output.decode('utf-8').split('\0')) - set(['']))
+
+    sources = glob.glob(os.path.join(root, '*.egg-info', 'SOURCES.txt'))
+    sources += glob.glob(os.path.join(root, '*', '*.egg-info', 'SOURCES.txt'))
+    if not sources:
+        return
+    files = set(['setup.py', 'MANIFEST.in'])
+    for path in sources:
+        with open(path, 'rb') as f:
+            files.update(line.strip() for line in
+                         f.read().decode('utf-8').splitlines()
+                         if '.egg-info/' not in line)
+    return sorted(files - set(['']))
+
+
+def tree_checksum(root='.'):
+    """
+    Hashes the paths and contents of the files the sdist is made of, see
+    source_files(). Without git or a previous build it's the whole tree but
+    VCS metadata, build products, compiled files and the timelines.
+    """
+    digest = hashlib.sha256()
+    files = source_files(root)
+    if files is not None:
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.isfile(path):  # Not deleted since
+                digest.update(name.encode('utf-8'))
+                digest.update(file_checksum(path).encode('ascii'))
+        return digest.hexdigest()
+
+    timelines = os.path.normpath(env.get('timeline_dir', TIMELINE_DIR))
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORE_DIRS and
+                         not d.endswith('.egg-info') and
+                         os.path.normpath(os.path.relpath(
+                             os.path.join(directory, d), root)) != timelines)
+        for name in sorted(files):
+            if name.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(directory, name)
+            digest.update(os.path.relpath(path, root).encode('utf-8'))
+            digest.update(file_checksum(path).encode('ascii'))
+    return digest.hexdigest()
+
+
+def newest():
+    """The most recent sdist in ``dist/``, using PEP 440 version ordering"""
+    dists = [Artifact(d) for d in os.listdir('dist') if d.endswith('.tar.gz')]
+    return max(dists, key=lambda d: parse_version(d.version))
+
+
+def save(tree, artifact):
+    """Records the build of ``artifact`` from ``tree`` in the cache"""
+    stat = os.stat(artifact.path)
+    with open(CACHE, 'w') as f:
+        json.dump({'tree': tree, 'file_name': artifact.file_name,
+                   'sha256': artifact.sha256, 'mtime': stat.st_mtime,
+                   'size': stat.st_size}, f)
+
+
+def build():
+    """
+    Runs ``setup.py sdist`` unless the source tree hasn't changed since the
+    last build, and returns the artifact to deploy. The checksum of a reused
+    sdist is recomputed if the file changed since it was recorded.
+    """
+    tree = tree_checksum()
+    cached = {}
+    if os.path.exists(CACHE):
+        with open(CACHE) as f:
+            cached = json.load(f)
+
+    if (cached.get('tree') == tree and
+            os.path.exists(os.path.join('dist', cached['file_name']))):
+        btw("Source tree unchanged, reusing {0}".format(cached['file_name']))
+        artifact = Artifact(cached['file_name'])
+        stat = os.stat(artifact.path)
+        if (stat.st_mtime, stat.st_size) == (cached.get('mtime'),
+                                             cached.get('size')):
+            return Artifact(cached['file_name'], cached['sha256'])
+        if artifact.sha256 != cached['sha256']:
+            btw("{0} changed since it was built".format(artifact.file_name))
+        save(tree, artifact)
+        return artifact
+
+    local('python setup.py sdist')
+    artifact = newest()
+    save(tree, artifact)
+    return artifact
+
+
+def wheel_command(pip, artifact_path, wheel_dir, find_links):
+    cmd = '{0} wheel --wheel-dir {1} {2} {3}'.format(
+        pip, wheel_dir, artifact_path, ' '.join(SERVER_PACKAGES))
+    for link in find_links:
+        cmd += ' --find-links {0}'.format(link)
+    if 'index_url' in env:
+        cmd += ' --index-url {0}'.format(env.index_url)
+    return cmd
+
+
+def wheelhouse(artifact):
+    """
+    Builds wheels for the artifact and all its dependencies into
+    ``wheelhouse/``, locally or on ``env.build_host`` if set.
+
+    Wheels that are already in the wheelhouse are reused by pip instead of
+    being built again.
+    """
+    if not os.path.exists(WHEELHOUSE):
+        os.makedirs(WHEELHOUSE)
+    links = [WHEELHOUSE] + [d for d in ['vendor'] if os.path.isdir(d)]
+
+    if 'build_host' not in env:
+        btw("Building wheels locally...")
+        local(wheel_command('pip', artifact.path, WHEELHOUSE, links))
+        prune_wheels(artifact)
+        return
+
+    btw("Building wheels on {0}...".format(env.build_host))
+    with settings(host_string=env.build_host):
+        try:
+            build = run('echo $HOME') + '/wheelhouse-build'
+            run('mkdir -p {0}/src {0}/wheels'.format(build))
+            if not run('test -d {0}/env && echo yes || true'.format(build)):
+                run('virtualenv --no-site-packages {0}/env'.format(build))
+                run('{0}/env/bin/pip install -U pip wheel'.format(build))
+
+            # The project's earlier sdists and wheels would pile up there too
+            run('cd {0} && rm -f src/{1}-*.tar.gz wheels/{2}-*.whl'.format(
+                build, artifact.name, artifact.name.replace('-', '_')))
+            remote_files = set(run(
+                'find {0}/src {0}/wheels -type f -printf "%f\\n"'.format(build)
+            ).split())
+            for link in links:
+                for name in set(os.listdir(link)) - remote_files:
+                    put(os.path.join(link, name), '{0}/src/{1}'.format(build,
+                                                                       name))
+            put(artifact.path, '{0}/src/{1}'.format(build, artifact.file_name))
+            run(wheel_command(
+                '{0}/env/bin/pip'.format(build),
+                '{0}/src/{1}'.format(build, artifact.file_name),
+                '{0}/wheels'.format(build),
+                ['{0}/wheels'.format(build), '{0}/src'.format(build)],
+            ))
+
+            # The project's wheel is rebuilt every time, the others are kept
+            local_wheels = set(os.listdir(WHEELHOUSE))
+            local_wheels.difference_update(own_wheels(artifact, local_wheels))
+            for name in run('ls {0}/wheels'.format(build)).split():
+                if name not in local_wheels:
+                    get('{0}/wheels/{1}'.format(build, name),
+                        os.path.join(WHEELHOUSE, name))
+        finally:
+            # Opened for env.build_host, a forked host task would inherit it
+            transport.close()
+    prune_wheels(artifact)
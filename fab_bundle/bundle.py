@@ -1,186 +1,430 @@
+import hashlib
+import json
 import os
+import time
 
 from io import BytesIO
 
-from fabric.api import task, env, run, local, put, cd, sudo
-from fabric.contrib.files import exists
+from fabric.api import task, env, cd
+from fabric.decorators import runs_once, serial
 
-from .utils import die, err, yay, template
+from . import artifacts, caches, envs, facts, render, sizing, sync
+from .fleet import on_hosts
+from .timing import phase, pipeline, run, put, sudo
+from .utils import die, err, btw, yay, template
 
+# One file per bundle, concatenated in the [databases] PgBouncer includes
+POOLS = '/etc/pgbouncer/databases.d'
 
-@task()
-def deploy(force_version=None):
-    """Deploys to the current bundle"""
-    bundle_name = env.http_host
-    bundle_root = '{0}/{1}'.format(
-        env.get('bundle_root', run('pwd') + '/bundles'),
-        bundle_name,
-    )
-    env.bundle_root = bundle_root
-    run('mkdir -p %s/{log,conf,public}' % bundle_root)
-
-    # virtualenv, Packages
-    if not exists(bundle_root + '/env'):
-        run('virtualenv --no-site-packages {0}/env'.format(bundle_root))
-    run('{0}/env/bin/pip install -U pip'.format(bundle_root))
-
-    local('python setup.py sdist')
-    dists = [
-        d for d in os.listdir(os.path.join(os.getcwd(),
-                                           'dist')) if d.endswith('.tar.gz')
-    ]
-    version_string = lambda d: d.rsplit('-', 1)[1][:-7]
-
-    def int_or_s(num):
-        try:
-            return int(num)
-        except ValueError:
-            return num
-    dist = sorted(dists, key=lambda d: map(int_or_s,
-                                           version_string(d).split('.')))[-1]
-    version = force_version or version_string(dist)
-    dist_name = dist.rsplit('-', 1)[0]
-    requirement = '{0}=={1}'.format(dist_name, version)
-
-    packages = env.bundle_root + '/packages'
-    run('mkdir -p {0}'.format(packages))
-    if not exists('{0}/{1}'.format(packages, dist)):
-        put('dist/{0}'.format(dist), '{0}/{1}'.format(packages, dist))
-
-    has_vendor = 'vendor' in os.listdir(os.getcwd())
-    if has_vendor:
-        local_files = set(os.listdir(os.path.join(os.getcwd(), 'vendor')))
-        uploaded = set(run('ls {0}'.format(packages)).split())
-        diff = local_files - uploaded
-        for file_name in diff:
-            put('vendor/{0}'.format(file_name),
-                '{0}/{1}'.format(packages, file_name))
-
-    freeze = run('{0}/env/bin/pip freeze'.format(bundle_root)).split()
-    if requirement in freeze and force_version is None:
-        die("{0} is already deployed. Increment the version number to deploy "
-            "a new release.".format(requirement))
-
-    cmd = ('{0}/env/bin/pip install -U {1} gunicorn gevent greenlet '
-           'setproctitle --find-links file://{2}'.format(
-               bundle_root, requirement, packages,
-           ))
-    if 'index_url' in env:
-        cmd += ' --index-url {0}'.format(env.index_url)
-    run(cmd)
-    env.path = bundle_root
-
-    manage_envdir(bundle_root)
-
-    if not 'staticfiles' in env:
-        env.staticfiles = True
-    if not 'cache' in env:
-        env.cache = 0  # redis DB
-
-    # Do we have a DB?
-    result = run('psql -U postgres -l|grep UTF8')
-    if bundle_name not in result:
-        if 'gis' in env and env.gis is False:
-            db_template = 'template0'
-        else:
-            db_template = 'template_postgis'
-        run('createdb -U postgres -T {0} -E UTF8 {1}').format(db_template,
-                                                              bundle_name)
-
-    if 'migrations' in env:
-        if env.migrations != 'nashvegas':
-            die("{0} is not supported for migrations.".format(env.migrations))
-        manage('upgradedb -l', noinput=False)  # This creates the migration
-                                               # tables
-
-        installed = run('psql -U postgres {0} -c "select id from '
-                        'nashvegas_migration limit 1;"'.format(bundle_name))
-        installed = '0 rows' not in installed
-        if installed:
-            manage('upgradedb -e', noinput=False)
-        else:
-            # 1st deploy, force syncdb and seed migrations.
-            manage('syncdb')
-            manage('upgradedb -s', noinput=False)
-    else:
-        manage('syncdb')
 
-    if env.staticfiles:
-        manage('collectstatic')
+def bundle_templates(root):
+    """
+    The (template, destination, context) of the config files of the current
+    bundle, in ``root``.
+    """
+    files = [
+        ('logrotate', '/etc/logrotate.d/%(app)s' % env, {}),
+        ('nginx.conf', root + '/conf/nginx.conf', {}),
+        ('supervisor.conf', root + '/conf/supervisor.conf', {}),
+        ('reload.sh', root + '/conf/reload.sh', {}),
+    ]
+    if env.get('staticfiles', True):
+        files.append(('static.py', root + '/conf/static.py', {}))
+    if env.get('pgbouncer'):
+        files.append(('pgbouncer-db.ini', '%s/%s.ini' % (POOLS, env.http_host),
+                      {}))
+    if 'cron' in env:
+        files.append(('cron', root + '/conf/cron', {}))
+    if 'rq' in env and env.rq and 'workers' in env.rq:
+        for worker_id in range(env.rq['workers']):
+            files.append(('rq.conf', '%s/conf/rq%s.conf' % (root, worker_id),
+                          {'worker_id': worker_id}))
+    if autoscaled():
+        files.append(('autoscale.py', root + '/conf/autoscale.py', {}))
+        files.append(('autoscale.conf', root + '/conf/autoscale.conf', {}))
+    return files
+
+
+def autoscaled():
+    """Whether the rq workers are started and stopped by the autoscaler"""
+    return 'rq' in env and env.rq and 'min_workers' in env.rq
+
+
+def pool_size():
+    """
+    Server connections PgBouncer keeps for the bundle. In transaction mode a
+    connection is only held during a transaction, a couple per gunicorn
+    worker and one per rq worker is plenty.
+    """
+    size = 2 * env.workers
+    if 'rq' in env and env.rq and 'workers' in env.rq:
+        size += env.rq['workers']
+    return max(size, 5)
+
+
+def database_url():
+    """The bundle's database, through PgBouncer's unix socket"""
+    scheme = 'postgis'
+    if 'gis' in env and env.gis is False:
+        scheme = 'postgres'
+    return '{0}://postgres@%2Fvar%2Frun%2Fpostgresql:6432/{1}'.format(
+        scheme, env.http_host)
+
+
+def bundle_files():
+    """
+    Destinations of the config files whose checksums are gathered with the
+    facts, ``{root}`` being the bundle root. The rq confs are handled by
+    ``worker_checksums()``.
+    """
+    return [destination for source, destination, _
+            in bundle_templates('{root}') if source != 'rq.conf']
+
+
+def worker_checksums(state):
+    """
+    Records the checksums of the rq worker confs, whose number is only known
+    once the bundle has been sized.
+    """
+    existing = {}
+    for line in state['worker_checksums'].splitlines():
+        sha256, path = line.split(None, 1)
+        existing[path] = sha256
+    for worker_id in range(env.rq['workers']):
+        path = '%s/conf/rq%s.conf' % (env.bundle_root, worker_id)
+        state.update('sha256:' + path, existing.get(path, ''))
+
+
+def prepare(artifact, contents=False):
+    """
+    Gathers the state of the bundle on the current host and renders its
+    config files, without changing anything on the host. Returns the facts
+    and a dict of destination -> rendered content.
+    """
+    env.artifact = artifact
 
     # Some things don't like dots
     env.app = env.http_host.replace('.', '')
 
-    # Cron tasks
-    if 'cron' in env:
-        template('cron', '%(bundle_root)s/conf/cron' % env, use_sudo=True)
-        sudo('chown root:root %(bundle_root)s/conf/cron' % env)
-        sudo('chmod 644 %(bundle_root)s/conf/cron' % env)
-        sudo('ln -sf %(bundle_root)s/conf/cron /etc/cron.d/%(app)s' % env)
-    else:
-        # Make sure to deactivate tasks if the cron section is removed
-        sudo('rm -f %(bundle_root)s/conf/cron /etc/cron.d/%(app)s' % env)
-
-    # Log rotation
-    logrotate = '/etc/logrotate.d/%(app)s' % env
-    template('logrotate', logrotate, use_sudo=True)
-    sudo('chown root:root %s' % logrotate)
-
-    # Nginx vhost
-    changed = template('nginx.conf', '%s/conf/nginx.conf' % bundle_root)
-    with cd('/etc/nginx/sites-available'):
-        sudo('ln -sf %s/conf/nginx.conf %s.conf' % (bundle_root,
-                                                    env.http_host))
-    with cd('/etc/nginx/sites-enabled'):
-        sudo('ln -sf ../sites-available/%s.conf' % env.http_host)
-    if 'ssl_cert' in env and 'ssl_key' in env:
-        put(env.ssl_cert, '%s/conf/ssl.crt' % bundle_root)
-        put(env.ssl_key, '%s/conf/ssl.key' % bundle_root)
-    if changed:  # TODO detect if the certs have changed
-        sudo('/etc/init.d/nginx reload')
-
-    # Supervisor task(s) -- gunicorn + rq
+    with phase('facts'):
+        state = facts.gather(env.http_host, bundle_files(), contents=contents)
+    env.bundle_root = state['root']
+
+    if env.get('autosize'):
+        sizing.autosize(state)
     if not 'workers' in env:
         env.workers = 2
-    changed = template('supervisor.conf',
-                       '%s/conf/supervisor.conf' % bundle_root)
-    with cd('/etc/supervisor/conf.d'):
-        sudo('ln -sf %s/conf/supervisor.conf %s.conf' % (bundle_root,
-                                                         bundle_name))
-
+    if not 'staticfiles' in env:
+        env.staticfiles = True
+    env.cache, env.cache_reason = caches.choose(state)  # redis DB
+    if not 'upstream_keepalive' in env:
+        env.upstream_keepalive = 16  # idle connections to gunicorn
+    if not 'pgbouncer' in env:
+        env.pgbouncer = False
+    if env.pgbouncer and not state['pgbouncer']:
+        err("PgBouncer isn't set up on {0}, connecting to postgres directly. "
+            "Run bootstrap again to install it.".format(env.host_string))
+        env.pgbouncer = False
+    if env.pgbouncer and not 'db_pool_size' in env:
+        env.db_pool_size = pool_size()
     if 'rq' in env and env.rq:
-        changed = True  # Always supervisorctl update
+        worker_checksums(state)
+
+    # Render everything before touching the server, template errors abort
+    # the deploy early and the output is reused when uploading.
+    with phase('render'):
+        rendered = render.render_all(bundle_templates(env.bundle_root))
+    return state, rendered
+
+
+def package_manifests(artifact, state):
+    """The local and remote manifests of the bundle's packages"""
+    local_files = [artifact.path]
+    local_dirs = ['vendor']
+    if env.get('wheelhouse'):
+        local_dirs.append(artifacts.WHEELHOUSE)
+    for local_dir in local_dirs:
+        if not local_dir in os.listdir(os.getcwd()):
+            continue
+        local_files.extend(os.path.join(local_dir, name)
+                           for name in os.listdir(local_dir))
+    local = sync.local_manifest(local_files, {artifact.path: artifact.sha256})
+    remote = sync.remote_manifest(state['packages'],
+                                  state['packages_manifest'])
+    return local, remote
+
+
+def dependencies_fingerprint(artifact, local):
+    """
+    The dependencies of ``artifact`` and the fingerprint of the virtualenv
+    they're installed in, ``local`` being the local package manifest.
+
+    The fingerprint is None when the requirements don't identify the
+    installed versions: some aren't pinned with == and they're resolved
+    against the index rather than the wheelhouse. The project's own sdist
+    and wheels aren't dependencies.
+    """
+    dependencies = artifact.dependencies()
+    if not env.get('wheelhouse') and not artifacts.pinned(dependencies):
+        return dependencies, None
+    own = set(artifacts.own_wheels(artifact, local))
+    return dependencies, artifacts.fingerprint(dependencies, dict(
+        (name, sha256) for name, (_, sha256, path) in local.items()
+        if path != artifact.path and name not in own
+    ))
+
+
+def verify(plan, state, rendered, version):
+    """
+    Dies unless the host is still in the state ``plan`` was made from and
+    the rendered config files are the planned ones.
+    """
+    changes = []
+    if version != plan['version']:
+        changes.append("version {0} instead of {1}".format(version,
+                                                          plan['version']))
+    if state['current'] != plan['current']:
+        changes.append("current release is {0} instead of {1}".format(
+            state['current'] or 'none', plan['current'] or 'none'))
+    for destination in sorted(set(rendered) | set(plan['files'])):
+        planned = plan['files'].get(destination)
+        if planned is None or destination not in rendered:
+            changes.append("{0} is {1} the plan".format(
+                destination, 'not in' if planned is None else 'only in'))
+            continue
+        if (hashlib.sha256(rendered[destination]).hexdigest() !=
+                planned['after']):
+            changes.append("{0} renders differently".format(destination))
+        if state.checksum(destination) != planned['before']:
+            changes.append("{0} changed on the host".format(destination))
+    if changes:
+        die("{0} doesn't match the plan anymore:\n  {1}".format(
+            env.host_string, '\n  '.join(changes)))
+    btw("Host matches the plan")
 
-        # RQ forks processes and they load the latest version of the code.
-        # No need to restart the worker **unless** RQ has been updated (TODO).
-        for worker_id in range(env.rq['workers']):
-            env.worker_id = worker_id
-            template(
-                'rq.conf', '%s/conf/rq%s.conf' % (bundle_root, worker_id),
-            )
-            with cd('/etc/supervisor/conf.d'):
-                sudo('ln -sf %s/conf/rq%s.conf %s_worker%s.conf' % (
-                    bundle_root, worker_id, bundle_name, worker_id,
-                ))
-
-        # Scale down workers if the number decreased
-        names = '/etc/supervisor/conf.d/{0}_worker*.conf'.format(bundle_name)
-        workers = run('ls {0}'.format(names))
-        workers_conf = run('ls {0}/conf/rq*.conf'.format(bundle_root))
-        to_delete = []
-        for w in workers.split():
-            if int(w.split('{0}_worker'.format(bundle_name),
-                           1)[1][:-5]) >= env.rq['workers']:
-                to_delete.append(w)
-        for w in workers_conf.split():
-            if int(w.split(bundle_name, 1)[1][8:-5]) >= env.rq['workers']:
-                to_delete.append(w)
-        if to_delete:
-            sudo('rm {0}'.format(" ".join(to_delete)))
-
-    if changed:
-        sudo('supervisorctl update')
-    run('kill -HUP `pgrep gunicorn`')
+
+@task()
+@runs_once
+@serial
+def deploy(force_version=None, plan=None):
+    """
+    Deploys to the current bundle. With ``plan``, a file saved by the plan
+    task, deploys exactly what was planned.
+    """
+    with phase('build'):
+        artifact = artifacts.build()
+    plans = None
+    if plan is not None:
+        with open(plan) as f:
+            saved = json.load(f)
+        if artifact.sha256 != saved['sha256']:
+            die("The plan is for {0} (sha256 {1}), not the current "
+                "build.".format(saved['artifact'], saved['sha256']))
+        force_version = saved['force_version']
+        plans = saved['hosts']
+    btw("Deploying {0} (sha256 {1})".format(artifact.file_name,
+                                            artifact.sha256))
+    if env.get('wheelhouse'):
+        with phase('wheelhouse'):
+            artifacts.wheelhouse(artifact)
+    on_hosts(deploy_bundle, artifact, force_version, plans)
+
+
+def deploy_bundle(artifact, force_version=None, plans=None):
+    """
+    Deploys ``artifact`` to the bundle on the current host, checking the
+    host's plan first if ``plans`` are given.
+    """
+    bundle_name = env.http_host
+    state, rendered = prepare(artifact)
+    bundle_root = env.bundle_root
+
+    version = force_version or artifact.version
+    requirement = artifact.requirement(version)
+    if plans is not None:
+        if env.host_string not in plans:
+            die("{0} isn't in the plan.".format(env.host_string))
+        verify(plans[env.host_string], state, rendered, version)
+    if version == state['current'] and force_version is None:
+        die("{0} is already deployed. Increment the version number to deploy "
+            "a new release.".format(requirement))
+    btw("Using redis DB {0} ({1})".format(env.cache, env.cache_reason))
+    caches.claim(state, env.cache_reason)
+
+    with phase('sync'):
+        run('mkdir -p %s/{log,conf,public,releases,run}' % bundle_root)
+        packages = bundle_root + '/packages'
+        local, remote = package_manifests(artifact, state)
+        if sync.sync(local, remote, packages):
+            state.invalidate('packages', 'packages_manifest')
+
+    with phase('release'):
+        # Each release gets its own virtualenv, switched to once it's ready
+        release = '{0}/releases/{1}'.format(bundle_root, version)
+        env.release = release
+        if version in state['releases'].split():
+            btw("Reusing the existing {0} release".format(version))
+            run('touch {0}'.format(release))
+        else:
+            # Dependencies come from a cached virtualenv, only the project
+            # itself is installed on top of it.
+            start = time.time()
+            dependencies, fingerprint = dependencies_fingerprint(artifact,
+                                                                 local)
+            envs.materialise(release + '/env', dependencies, fingerprint,
+                             packages)
+            run(envs.pip_install('{0}/env/bin/pip'.format(release),
+                                 [requirement], packages))
+            btw("Installed {0} in {1:.1f}s".format(requirement,
+                                                    time.time() - start))
+            run('touch {0}/.complete'.format(release))
+            state.invalidate('releases')
+    env.path = bundle_root
+
+    with phase('envdir'):
+        manage_envdir(bundle_root)
+
+    with phase('database'):
+        # Do we have a DB?
+        created = False
+        if state['database'] != bundle_name:
+            if 'gis' in env and env.gis is False:
+                db_template = 'template0'
+            else:
+                db_template = 'template_postgis'
+            run('createdb -U postgres -T {0} -E UTF8 {1}'.format(db_template,
+                                                                 bundle_name))
+            state.invalidate('database')
+            created = True
+
+        # Connections go through PgBouncer, in transaction pooling mode
+        if env.pgbouncer:
+            pool = '%s/%s.ini' % (POOLS, bundle_name)
+            if template('pgbouncer-db.ini', pool, use_sudo=True):
+                sudo('cat {0}/*.ini > /etc/pgbouncer/databases.ini && '
+                     '/etc/init.d/pgbouncer reload'.format(POOLS))
+
+        # syncdb and the migrations are Django startups, only run them when
+        # the models, migrations or dependencies changed
+        resolved = None
+        if dependencies_fingerprint(artifact, local)[1] is None:
+            resolved = resolved_dependencies(env.release + '/env')
+        schema = schema_fingerprint(artifact, local, resolved)
+        if schema == state['schema'] and not created:
+            btw("Schema unchanged ({0}), skipping syncdb and "
+                "migrations".format(schema))
+        else:
+            btw("Schema changed ({0} -> {1}), migrating".format(
+                state['schema'] or 'none', schema))
+            migrate(bundle_name)
+            run('echo {0} > {1}/conf/schema'.format(schema, bundle_root))
+            state.invalidate('schema')
+
+    with phase('collectstatic'):
+        if env.staticfiles:
+            collectstatic(bundle_root)
+
+    # Nothing here needs the output of the commands, they're sent together
+    with phase('config'), pipeline() as commands:
+        # Cron tasks
+        if 'cron' in env:
+            template('cron', '%(bundle_root)s/conf/cron' % env, use_sudo=True)
+            commands.sudo('chown root:root %(bundle_root)s/conf/cron' % env)
+            commands.sudo('chmod 644 %(bundle_root)s/conf/cron' % env)
+            commands.sudo('ln -sf %(bundle_root)s/conf/cron '
+                          '/etc/cron.d/%(app)s' % env)
+        else:
+            # Make sure to deactivate tasks if the cron section is removed
+            commands.sudo('rm -f %(bundle_root)s/conf/cron '
+                          '/etc/cron.d/%(app)s' % env)
+
+        # Log rotation
+        logrotate = '/etc/logrotate.d/%(app)s' % env
+        template('logrotate', logrotate, use_sudo=True)
+        commands.sudo('chown root:root %s' % logrotate)
+
+        # Nginx vhost
+        changed = template('nginx.conf', '%s/conf/nginx.conf' % bundle_root)
+        with cd('/etc/nginx/sites-available'):
+            commands.sudo('ln -sf %s/conf/nginx.conf %s.conf' % (
+                bundle_root, env.http_host))
+        with cd('/etc/nginx/sites-enabled'):
+            commands.sudo('ln -sf ../sites-available/%s.conf' % env.http_host)
+        if 'ssl_cert' in env and 'ssl_key' in env:
+            put(env.ssl_cert, '%s/conf/ssl.crt' % bundle_root)
+            put(env.ssl_key, '%s/conf/ssl.key' % bundle_root)
+        if changed:  # TODO detect if the certs have changed
+            commands.sudo('/etc/init.d/nginx reload')
+
+        # Supervisor task(s) -- gunicorn + rq
+        changed = template('supervisor.conf',
+                           '%s/conf/supervisor.conf' % bundle_root)
+        with cd('/etc/supervisor/conf.d'):
+            commands.sudo('ln -sf %s/conf/supervisor.conf %s.conf' % (
+                bundle_root, bundle_name))
+
+        if 'rq' in env and env.rq:
+            changed = True  # Always supervisorctl update
+
+            # RQ forks processes and they load the latest version of the
+            # code. No need to restart the worker **unless** RQ has been
+            # updated (TODO).
+            for worker_id in range(env.rq['workers']):
+                env.worker_id = worker_id
+                template(
+                    'rq.conf', '%s/conf/rq%s.conf' % (bundle_root, worker_id),
+                )
+                with cd('/etc/supervisor/conf.d'):
+                    commands.sudo('ln -sf %s/conf/rq%s.conf '
+                                  '%s_worker%s.conf' % (
+                                      bundle_root, worker_id, bundle_name,
+                                      worker_id))
+
+            # Scale down workers if the number decreased
+            # Workers added by this deploy are below the limit, the snapshot is
+            # enough to find the ones to remove.
+            workers = state['workers']
+            workers_conf = state['worker_confs']
+            to_delete = []
+            for w in workers.split():
+                if int(w.split('{0}_worker'.format(bundle_name),
+                               1)[1][:-5]) >= env.rq['workers']:
+                    to_delete.append(w)
+            for w in workers_conf.split():
+                if int(w.split(bundle_name, 1)[1][8:-5]) >= env.rq['workers']:
+                    to_delete.append(w)
+            if to_delete:
+                commands.sudo('rm {0}'.format(" ".join(to_delete)))
+                state.invalidate('workers', 'worker_confs')
+
+        # Workers above env.rq['min_workers'] are started on demand
+        autoscaler = '{0}_autoscaler'.format(bundle_name)
+        installed = autoscaler + '.conf' in state['bundles'].split()
+        if autoscaled():
+            script = template('autoscale.py',
+                              '%s/conf/autoscale.py' % bundle_root)
+            template('autoscale.conf', '%s/conf/autoscale.conf' % bundle_root)
+            if not installed:
+                with cd('/etc/supervisor/conf.d'):
+                    commands.sudo('ln -sf %s/conf/autoscale.conf %s.conf' % (
+                        bundle_root, autoscaler))
+            elif script:
+                commands.sudo('supervisorctl restart {0}'.format(autoscaler))
+        elif installed:
+            commands.sudo('rm /etc/supervisor/conf.d/{0}.conf'.format(
+                autoscaler))
+            changed = True
+
+        template('reload.sh', '%s/conf/reload.sh' % bundle_root)
+    with phase('reload'):
+        switch(version)
+        if changed:
+            sudo('supervisorctl update')
+        reload()
+        if env.get('microcache'):
+            purge_cache()
+    with phase('cleanup'):
+        cleanup(version)
 
     # All set, user feedback
     ip = run('curl http://ifconfig.me/')
@@ -199,19 +443,144 @@ def destroy():
     pass
 
 
+@task()
+@runs_once
+@serial
+def rollback(version=None):
+    """Switches back to the previous release, or to the given version"""
+    on_hosts(rollback_bundle, version)
+
+
+def rollback_bundle(version=None):
+    """Switches the bundle on the current host to another release"""
+    state = facts.gather(env.http_host)
+    env.bundle_root = state['root']
+    releases = state['releases'].split()
+    current = state['current']
+
+    if version is None:
+        # Releases are listed most recently deployed first
+        if current in releases:
+            releases = releases[releases.index(current) + 1:]
+        if not releases:
+            die("There is no release to roll back to.")
+        version = releases[0]
+    elif version not in releases:
+        die("Release {0} isn't available. Available releases: {1}".format(
+            version, ', '.join(releases)))
+
+    switch(version)
+    reload()
+    if env.get('microcache'):
+        purge_cache()
+    cleanup(version)
+    yay("Rolled back from {0} to {1}".format(current, version))
+
+
+def switch(version):
+    """Atomically points the bundle's ``current`` symlink to a release"""
+    run('cd {0} && ln -sfn releases/{1} current.new && '
+        'mv -T current.new current'.format(env.bundle_root, version))
+    facts.current().invalidate('current')
+
+
+def reload():
+    """
+    Gracefully reloads the bundle's gunicorn and waits until its new workers
+    answer requests.
+    """
+    start = time.time()
+    ready = run('bash %(bundle_root)s/conf/reload.sh' % env)
+    yay("Reloaded {0}, {1} ({2:.1f}s including the round trip)".format(
+        env.http_host, ready, time.time() - start))
+
+
+def purge_cache():
+    """Empties the bundle's nginx cache, pages are cached by nginx workers"""
+    sudo('rm -rf %(bundle_root)s/cache/*' % env)
+
+
+def cleanup(version):
+    """
+    Makes ``env`` point to the current release, replacing the virtualenv of
+    bundles deployed before releases existed, and removes the oldest releases
+    to keep ``env.keep_releases`` of them.
+    """
+    keep = int(env.get('keep_releases', 5))
+    run('cd {0} && ([ -L env ] || rm -rf env) && ln -sfn current/env env && '
+        'cd releases && ls -t | grep -vx {1} | tail -n +{2} | '
+        'xargs -r rm -rf'.format(env.bundle_root, version, keep))
+    facts.current().invalidate('releases')
+
+
+def schema_fingerprint(artifact, local, resolved=None):
+    """
+    Identifies what the database phase depends on: the models and migrations
+    shipped in ``artifact``, its dependencies, which may have models too,
+    and the way migrations are run. ``local`` is the local package manifest.
+
+    Unpinned dependencies are identified by ``resolved``, the ``pip freeze``
+    of the release. Returns None if it's needed and not given. The project's
+    own line is left out, its models and migrations are hashed already and
+    its version changes with every release.
+    """
+    _, dependencies = dependencies_fingerprint(artifact, local)
+    if dependencies is None:
+        if resolved is None:
+            return
+        project = artifacts.canonical(artifact.name)
+        resolved = '\n'.join(
+            line for line in resolved.splitlines()
+            if artifacts.canonical(line.split('==', 1)[0]) != project)
+        dependencies = hashlib.sha256(resolved).hexdigest()
+    digest = hashlib.sha256(artifact.schema_checksum().encode('ascii'))
+    digest.update(dependencies.encode('ascii'))
+    digest.update(repr((env.get('migrations'), env.get('gis'))).encode(
+        'utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def resolved_dependencies(virtualenv):
+    """The versions installed in ``virtualenv``, from ``pip freeze``"""
+    return run('{0}/bin/pip freeze'.format(virtualenv))
+
+
+def migrate(bundle_name):
+    """Runs syncdb and the migrations of the release being deployed"""
+    if 'migrations' not in env:
+        manage('syncdb')
+        return
+    if env.migrations != 'nashvegas':
+        die("{0} is not supported for migrations.".format(env.migrations))
+    manage('upgradedb -l', noinput=False)  # This creates the migration tables
+
+    installed = run('psql -U postgres -tAc "select exists (select 1 from '
+                    'nashvegas_migration)" {0}'.format(bundle_name))
+    if installed == 't':
+        manage('upgradedb -e', noinput=False)
+    else:
+        # 1st deploy, force syncdb and seed migrations.
+        manage('syncdb')
+        manage('upgradedb -s', noinput=False)
+
+
 def manage_envdir(bundle_root):
-    # Envdir configuration
-    if not 'env' in env:
-        env.env = {}
+    # Envdir configuration, copied so that defaults don't leak to other hosts
+    env.env = dict(env.get('env', {}))
     if not 'MEDIA_ROOT' in env.env:
         env.env['MEDIA_ROOT'] = bundle_root + '/public/media'
     if not 'STATIC_ROOT' in env.env:
         env.env['STATIC_ROOT'] = bundle_root + '/public/static'
+    if env.pgbouncer and not 'DATABASE_URL' in env.env:
+        env.env['DATABASE_URL'] = database_url()
+    if not 'REDIS_URL' in env.env:
+        env.env['REDIS_URL'] = 'redis://localhost:6379/{0}'.format(env.cache)
 
     envdir = bundle_root + '/envdir'
     run('mkdir -p {0}'.format(envdir))
 
-    delete = set(run('ls {0}'.format(envdir)).split()) - set(env.env.keys())
+    state = facts.current()
+    delete = set(state['envdir'].split()) - set(env.env.keys())
     if delete:
         run('rm {0}'.format(
             ' '.join('{0}/{1}'.format(envdir, key) for key in delete)))
@@ -219,11 +588,36 @@ def manage_envdir(bundle_root):
     for name, value in env.env.items():
         path = '{0}/{1}'.format(envdir, name)
         put(BytesIO(value), path)
-
-
-def manage(command, noinput=True):
-    """Runs a management command"""
+    state.invalidate('envdir')
+
+
+def collectstatic(bundle_root):
+    """
+    Collects the static files of the release as symlinks, then copies the
+    ones that changed since the last deploy to ``STATIC_ROOT`` along with
+    their compressed versions.
+    """
+    links = bundle_root + '/static-links'
+    script = bundle_root + '/conf/static.py'
+    template('static.py', script)
+    manage('collectstatic --link --clear', environ={'STATIC_ROOT': links})
+    result = run('{0}/env/bin/python {1} {2} {3} {4}/conf/static.json'.format(
+        env.release, script, links, env.env['STATIC_ROOT'], bundle_root))
+    btw("Static files: {0}".format(result))
+
+
+def manage(command, noinput=True, environ=None):
+    """
+    Runs a management command, using the release being deployed. ``environ``
+    overrides variables from the envdir.
+    """
     noinput = '--noinput' if noinput else ''
-    run('envdir {bundle_root}/envdir {bundle_root}/env/bin/django-admin.py '
-        '{command} {noinput}'.format(bundle_root=env.bundle_root,
-                                     command=command, noinput=noinput))
+    release = env.get('release', env.bundle_root + '/current')
+    overrides = ''
+    if environ:
+        overrides = 'env {0} '.format(' '.join(
+            '{0}={1}'.format(key, value) for key, value in environ.items()))
+    run('envdir {bundle_root}/envdir {overrides}{release}/env/bin/'
+        'django-admin.py {command} {noinput}'.format(
+            bundle_root=env.bundle_root, overrides=overrides,
+            release=release, command=command, noinput=noinput))
@@ -0,0 +1,79 @@
+"""
+Redis databases of the bundles of a host, so that they don't share one
+"""
+import urlparse
+
+from fabric.api import env
+from fabric.context_managers import settings
+
+from .timing import run
+from .utils import die
+
+# One file per bundle, named after it and containing its DB number
+REGISTRY = '.fab-bundle/redis'
+# Redis' default number of databases, DB 0 is left to bundles deployed before
+# databases were allocated
+DATABASES = 16
+
+
+def allocations(state):
+    """Bundle name -> redis DB, as recorded on the host"""
+    allocated = {}
+    for line in state['redis'].splitlines():
+        path, db = line.rsplit(':', 1)
+        allocated[path.rsplit('/', 1)[1]] = int(db)
+    return allocated
+
+
+def deployed(state):
+    """
+    Whether the current bundle was deployed before, by this version or by
+    one without releases (a virtualenv in the bundle root).
+    """
+    return bool(state['deployed']) or (
+        env.http_host + '.conf' in state['bundles'].split())
+
+
+def choose(state):
+    """
+    The redis DB of the current bundle and why: ``env.cache`` or the DB of
+    ``REDIS_URL`` if set, the DB allocated on a previous deploy, DB 0 for
+    bundles deployed before databases were allocated, the first free DB
+    otherwise.
+    """
+    if 'cache' in env:
+        return int(env.cache), 'env.cache'
+    if 'REDIS_URL' in env.get('env', {}):
+        path = urlparse.urlparse(env.env['REDIS_URL']).path.strip('/')
+        return int(path or 0), 'REDIS_URL'
+    allocated = allocations(state)
+    if env.http_host in allocated:
+        return allocated[env.http_host], 'allocated'
+    if deployed(state):
+        return 0, 'deployed before allocation, set env.cache to move'
+    taken = set(allocated.values())
+    for db in range(1, DATABASES):
+        if db not in taken:
+            return db, 'new'
+    die("All {0} redis databases are allocated on {1}. Set env.cache to "
+        "share one.".format(DATABASES, env.host_string))
+
+
+def claim(state, reason):
+    """
+    Records the DB of the current bundle on the host. A new DB is only
+    claimed if no other bundle took it meanwhile.
+    """
+    if allocations(state).get(env.http_host) == env.cache:
+        return
+    script = 'echo {0} > {1}'.format(env.cache, env.http_host)
+    if reason == 'new':
+        script = '! grep -lx {0} * 2>/dev/null | grep -vqx {1} && {2}'.format(
+            env.cache, env.http_host, script)
+    with settings(warn_only=True):
+        result = run("mkdir -p {0} && cd {0} && flock .lock sh -c "
+                     "'{1}'".format(REGISTRY, script))
+    if result.failed:
+        die("Redis DB {0} was just allocated to another bundle on {1}, "
+            "deploy again.".format(env.cache, env.host_string))
+    state.invalidate('redis')
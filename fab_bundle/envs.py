@@ -0,0 +1,85 @@
+"""
+Shared cache of virtualenvs on a bundle container, keyed by the fingerprint
+of their dependencies
+"""
+from fabric.api import env
+
+from . import facts
+from .artifacts import SERVER_PACKAGES
+from .timing import run
+from .utils import btw
+
+CACHE = '.fab-bundle/envs'
+
+
+def pip_install(pip, requirements, packages, upgrade=False):
+    """Builds a pip install command using the bundle's packages"""
+    cmd = '{0} install {1}{2} --find-links file://{3}'.format(
+        pip, '-U ' if upgrade else '', ' '.join(requirements), packages)
+    if env.get('wheelhouse'):
+        cmd += ' --no-index --only-binary :all:'
+    elif 'index_url' in env:
+        cmd += ' --index-url {0}'.format(env.index_url)
+    return cmd
+
+
+def build(path, dependencies, packages):
+    """Creates a virtualenv in ``path`` with the given dependencies"""
+    run('rm -rf {0} && mkdir -p {0} && virtualenv --no-site-packages '
+        '{0}'.format(path))
+    if not env.get('wheelhouse'):
+        # Wheelhouse installs don't touch the index, not even for pip
+        run('{0}/bin/pip install -U pip'.format(path))
+    run(pip_install('{0}/bin/pip'.format(path),
+                    dependencies + SERVER_PACKAGES, packages, upgrade=True))
+    run('touch {0}/.complete'.format(path))
+
+
+def clone(source, destination):
+    """
+    Copies a virtualenv using reflinks where the filesystem supports them,
+    hard links otherwise, and fixes the paths in its scripts. Scripts are
+    rewritten by ``sed -i`` which replaces the files, so the cached
+    virtualenv is left untouched.
+    """
+    run('rm -rf {1} && mkdir -p $(dirname {1}) && '
+        '(cp -a --reflink=always {0} {1} 2>/dev/null || '
+        '(rm -rf {1} && cp -al {0} {1})) && rm -f {1}/.complete && '
+        'grep -rlI {0} {1}/bin | xargs -r sed -i "s|{0}|{1}|g"'.format(
+            source, destination))
+
+
+def evict(keep):
+    """
+    Removes the least recently used virtualenvs once the cache takes more
+    than ``env.env_cache_size`` megabytes (2048 by default). ``keep`` is
+    never removed.
+    """
+    budget = int(env.get('env_cache_size', 2048))
+    run('cd {0} && total=0 && for e in $(ls -t); do '
+        'total=$((total + $(du -sm $e | cut -f1))); '
+        'if [ $total -gt {1} ] && [ $e != {2} ]; then rm -rf $e; fi; '
+        'done'.format(CACHE, budget, keep))
+
+
+def materialise(path, dependencies, fingerprint, packages):
+    """
+    Creates the virtualenv at ``path`` from the cached one with the same
+    fingerprint, building it first if needed. Without a fingerprint, it's
+    built in place with the latest versions the requirements allow.
+    """
+    if fingerprint is None:
+        btw("Dependencies aren't all pinned with ==, building them...")
+        build(path, dependencies, packages)
+        return
+    state = facts.current()
+    cached = '{0}/{1}/{2}'.format(state['home'], CACHE, fingerprint)
+    if fingerprint in state['envs'].split():
+        btw("Reusing cached dependencies {0}".format(fingerprint))
+        run('touch {0}'.format(cached))
+    else:
+        btw("Building dependencies {0}...".format(fingerprint))
+        build(cached, dependencies, packages)
+        state.invalidate('envs')
+        evict(fingerprint)
+    clone(cached, path)
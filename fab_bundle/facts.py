@@ -0,0 +1,224 @@
+"""
+Remote state, gathered in a single round trip
+"""
+from fabric.api import env, hide
+
+from .timing import run
+
+MARKER = '@@fab-bundle:'
+FILE_MARKER = '@@fab-bundle-file:'
+
+# Prints the SHA-256 of a file, '?' if it exists but isn't readable and
+# nothing if it doesn't exist.
+CHECKSUM = ('if [ -r {0} ]; then sha256sum {0} | cut -c-64; '
+            'elif [ -e {0} ]; then echo "?"; fi')
+
+
+def parse(output):
+    """
+    Splits the output of a facts script into a dict of key -> output.
+    """
+    sections = {}
+    key = None
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            key = line[len(MARKER):].strip()
+            sections[key] = []
+        elif key is not None:
+            sections[key].append(line)
+    return dict((k, '\n'.join(v).strip()) for k, v in sections.items())
+
+
+def parse_files(output):
+    """
+    Splits the output of a ``files`` probe into a dict of path -> content.
+    """
+    files = {}
+    path = None
+    for line in output.splitlines():
+        if line.startswith(FILE_MARKER):
+            path = line[len(FILE_MARKER):].strip()
+            files[path] = []
+        elif path is not None:
+            files[path].append(line)
+    return dict((k, '\n'.join(v).rstrip('\n')) for k, v in files.items())
+
+
+class Facts(object):
+    """
+    A snapshot of the remote state of the current host.
+
+    Probes are shell snippets keyed by name. They're all run in a single
+    script by ``gather()``, and each key is re-probed on its own when it's
+    read after having been invalidated.
+    """
+    def __init__(self, prelude='', probes=()):
+        self.prelude = prelude
+        self.probes = dict(probes)
+        self.data = {}
+
+    def script(self, keys):
+        lines = [self.prelude] if self.prelude else []
+        for key in keys:
+            lines.append("echo '{0}{1}'".format(MARKER, key))
+            lines.append('{{ {0} ; }} 2>/dev/null'.format(self.probes[key]))
+        lines.append('true')  # probes are allowed to fail
+        return '\n'.join(lines)
+
+    def gather(self, keys=None):
+        if keys is None:
+            keys = sorted(self.probes)
+        if not keys:
+            return
+        with hide('running', 'stdout'):
+            output = run(self.script(keys))
+        self.data.update(parse(output))
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            self.gather([key])
+        return self.data[key]
+
+    def get(self, key, default=None):
+        if key not in self.probes and key not in self.data:
+            return default
+        return self[key]
+
+    def invalidate(self, *keys):
+        """Forgets the given keys, they'll be probed again when needed"""
+        for key in keys:
+            self.data.pop(key, None)
+
+    def update(self, key, value):
+        """Records a value that's known without asking the host"""
+        self.data[key] = value
+
+    def checksum(self, path):
+        """
+        SHA-256 of a remote file, empty if it doesn't exist and '?' if it's
+        not readable without sudo.
+        """
+        key = 'sha256:' + path
+        if key not in self.probes:
+            self.probes[key] = CHECKSUM.format(path)
+        return self[key]
+
+
+_snapshots = {}
+
+
+def current():
+    """
+    Returns the facts snapshot for the current host, creating an empty one
+    if nothing has been gathered yet.
+    """
+    if env.host_string not in _snapshots:
+        _snapshots[env.host_string] = Facts()
+    return _snapshots[env.host_string]
+
+
+def gather_host(packages, paths=()):
+    """
+    Gathers the provisioning state of the current host in a single remote
+    call: the state recorded by the last bootstrap, which of the debian
+    ``packages`` are installed and the checksums of ``paths``.
+    """
+    probes = {
+        'home': 'pwd',
+        'provisioned': 'cat .fab-bundle/provisioning.json',
+        'installed': ("dpkg-query -W -f='${{Status}} ${{Package}}\\n' {0} | "
+                      "awk '$3 == \"installed\" {{print $4}}'".format(
+                          ' '.join(packages))),
+        # Libraries PIL looks for in /usr/lib, see provisioning.packages()
+        'libs': ('ls -d /usr/lib/{libz,libjpeg,libfreetype}.so '
+                 '/usr/lib/*-linux-gnu/{libz,libjpeg,libfreetype}.so'),
+        'pg_version': 'ls /etc/postgresql',
+        'memory': "awk '/^MemTotal/ {print $2}' /proc/meminfo",
+        'postgis': ('psql -U postgres -tAc "select count(*) from pg_database '
+                    'where datname = \'template_postgis\'"'),
+        'running': ('pgrep -x nginx >/dev/null && echo nginx; '
+                    'pgrep -x supervisord >/dev/null && echo supervisor; '
+                    'pgrep -x pgbouncer >/dev/null && echo pgbouncer'),
+    }
+    for path in paths:
+        probes['sha256:' + path] = CHECKSUM.format(path)
+
+    facts = Facts('cd', probes)
+    facts.gather()
+    _snapshots[env.host_string] = facts
+    return facts
+
+
+def gather(bundle_name, paths=(), contents=False):
+    """
+    Gathers the state of a bundle in a single remote call. ``paths`` are
+    files whose checksum should be known, ``{root}`` is replaced with the
+    bundle root. With ``contents``, the content of these files and of the rq
+    confs is gathered as well, see ``parse_files()``.
+    """
+    if 'bundle_root' in env:
+        base = env.bundle_root
+    else:
+        base = '$HOME/bundles'
+    prelude = 'cd; ROOT={0}/{1}'.format(base, bundle_name)
+    probes = {
+        'root': 'echo $ROOT',
+        'home': 'pwd',
+        # Complete releases, most recently deployed first
+        'releases': ('for r in $(ls -t $ROOT/releases); do '
+                     'test -e $ROOT/releases/$r/.complete && echo $r; done'),
+        'current': 'basename $(readlink $ROOT/current)',
+        # Any of these means the bundle has been deployed, possibly before
+        # releases existed
+        'deployed': 'ls -d $ROOT/current $ROOT/env $ROOT/envdir',
+        # Cached virtualenvs, see envs.py
+        'envs': ('for e in $(ls .fab-bundle/envs); do '
+                 'test -e .fab-bundle/envs/$e/.complete && echo $e; done'),
+        'packages': ('find $ROOT/packages -maxdepth 1 -type f ! -name ".*" '
+                     '-printf "%s %f\\n"'),
+        'packages_manifest': 'cat $ROOT/packages/.manifest',
+        # The bundle's database if it exists
+        'database': ('psql -U postgres -tAc "select datname from pg_database '
+                     'where datname = \'{0}\'"'.format(bundle_name)),
+        # Fingerprint of the schema as of the last database phase
+        'schema': 'cat $ROOT/conf/schema',
+        'envdir': 'ls $ROOT/envdir',
+        'workers': 'ls /etc/supervisor/conf.d/{0}_worker*.conf'.format(
+            bundle_name),
+        'worker_confs': 'ls $ROOT/conf/rq*.conf',
+        'worker_checksums': 'sha256sum $ROOT/conf/rq*.conf',
+        # Host resources, for sizing
+        'cpus': 'nproc',
+        'memory': "awk '/^MemTotal/ {print $2}' /proc/meminfo",
+        'bundles': 'ls /etc/supervisor/conf.d',
+        'pgbouncer': 'test -d /etc/pgbouncer/databases.d && echo yes',
+        # Redis DBs allocated to the bundles, see caches.py
+        'redis': 'grep -H . .fab-bundle/redis/*',
+    }
+    for path in paths:
+        probes['sha256:' + path] = CHECKSUM.format(path.format(root='$ROOT'))
+    if contents:
+        # Each file starts on a new line, whether or not the previous one
+        # ends with a newline
+        probes['files'] = (
+            'for f in {0} $ROOT/conf/rq*.conf; do [ -r $f ] && '
+            'printf "\\n{1}%s\\n" $f && cat $f; done'.format(
+                ' '.join(path.format(root='$ROOT') for path in paths),
+                FILE_MARKER))
+
+    facts = Facts(prelude, probes)
+    facts.gather()
+
+    # Now that the root is known, key paths by their real location
+    root = facts.data['root']
+    for path in paths:
+        key = 'sha256:' + path
+        real_key = 'sha256:' + path.format(root=root)
+        facts.probes[real_key] = facts.probes.pop(key)
+        facts.data[real_key] = facts.data.pop(key)
+
+    _snapshots[env.host_string] = facts
+    return facts
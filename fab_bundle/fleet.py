@@ -0,0 +1,97 @@
+"""
+Running tasks on all the hosts, serially or in parallel
+"""
+import time
+
+from fabric.api import env, execute
+from fabric.context_managers import settings
+
+from . import timing, transport
+from .utils import die, err, btw, fyi, yay
+
+
+class HostFailure(Exception):
+    """Raised instead of exiting when a task aborts on a host"""
+
+
+def on_hosts(func, *args, **kwargs):
+    """
+    Runs ``func`` on every host and prints a per-host summary. Returns a
+    dict of host -> (status, duration, error, return value).
+
+    Hosts are handled in parallel if ``env.parallel`` is set (``fab -P``),
+    with at most ``env.pool_size`` (``fab -z``) hosts at a time. Failures
+    don't stop the other hosts, the task is aborted at the end if any host
+    failed.
+
+    The timeline of each host is exported and its slowest steps are shown,
+    see ``timing.export()``.
+    """
+    def host_task():
+        saved = dict(env)
+        start = time.time()
+        value = None
+        env.timed_host = env.host_string
+        try:
+            with settings(abort_exception=HostFailure):
+                value = func(*args, **kwargs)
+        except Exception as e:
+            status, error = 'failed', str(e) or e.__class__.__name__
+        else:
+            status, error = 'ok', ''
+        finally:
+            report(func.__name__)
+            transport.close()
+            # Don't leak a host's settings into the next one
+            env.clear()
+            env.update(saved)
+        return status, time.time() - start, error, value
+
+    # Keeps idle connections alive during long local steps
+    with settings(abort_on_prompts=env.parallel or env.abort_on_prompts,
+                  keepalive=env.keepalive or 30):
+        results = execute(host_task)
+
+    with settings(host_string=None):
+        summary(results)
+        failed = [host for host, result in results.items()
+                  if result[0] != 'ok']
+        if failed:
+            die("Failed on {0} host(s): {1}".format(
+                len(failed), ', '.join(sorted(failed))))
+    return results
+
+
+def report(task_name):
+    """Exports the timeline of the current host and shows its slowest steps"""
+    path = timing.export(task_name)
+    if path is None:
+        return
+    phases, commands = timing.slowest()
+    trips, calls, duration = timing.round_trips()
+    if trips:
+        btw("{0} round trips for {1} commands and transfers, {2:.0f}ms "
+            "on average".format(trips, calls, duration * 1000 / trips))
+    if phases:
+        btw("Phases: {0}".format(', '.join(
+            '{0} {1:.1f}s'.format(name, duration)
+            for name, duration in phases)))
+    if commands:
+        btw("Slowest steps:")
+        for name, duration in commands:
+            btw("  {0:>6.1f}s  {1}".format(duration, name))
+    btw("Timeline saved to {0}".format(path))
+    timing.reset()
+
+
+def summary(results):
+    width = max([len(host) for host in results] + [4])
+    line = '{0:<%s}  {1:<6}  {2:>8}' % width
+    fyi(line.format('Host', 'Status', 'Time'))
+    for host in sorted(results):
+        status, duration, error, _ = results[host]
+        row = line.format(host, status, '%.1fs' % duration)
+        if status == 'ok':
+            yay(row)
+        else:
+            err('{0}  {1}'.format(row, error.strip().split('\n')[-1]))
@@ -0,0 +1,174 @@
+"""
+Dry runs: what a deploy would change on each host, without changing anything
+"""
+import difflib
+import hashlib
+import json
+
+from fabric.api import task, env
+from fabric.decorators import runs_once, serial
+
+from . import artifacts, caches, facts, sync
+from .bundle import (POOLS, dependencies_fingerprint, package_manifests,
+                     prepare, resolved_dependencies, schema_fingerprint)
+from .fleet import on_hosts
+from .utils import die, btw, fyi, yay
+
+
+@task()
+@runs_once
+@serial
+def plan(output=None, force_version=None):
+    """
+    Shows what deploy would do on each host. With ``output``, saves the plan
+    to be applied with deploy:plan=<output>.
+    """
+    artifact = artifacts.build()
+    btw("Planning {0} (sha256 {1})".format(artifact.file_name,
+                                           artifact.sha256))
+    results = on_hosts(plan_bundle, artifact, force_version)
+    if output is None:
+        return
+    saved = {
+        'artifact': artifact.file_name,
+        'sha256': artifact.sha256,
+        'force_version': force_version,
+        'hosts': dict((host, result[3]) for host, result in results.items()),
+    }
+    with open(output, 'w') as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+    yay("Plan saved to {0}, apply it with deploy:plan={0}".format(output))
+
+
+def unified_diff(before, after, path):
+    """Diff between the content of a file on the host and the planned one"""
+    return '\n'.join(difflib.unified_diff(
+        before.splitlines() if before else [],
+        after.rstrip('\n').splitlines(),
+        '{0} (host)'.format(path), '{0} (planned)'.format(path),
+        lineterm=''))
+
+
+def plan_bundle(artifact, force_version=None):
+    """
+    Computes what deploying ``artifact`` would do on the current host, shows
+    it and returns it as a serialisable dict.
+    """
+    state, rendered = prepare(artifact, contents=True)
+    version = force_version or artifact.version
+    current = state['current']
+    if version == current and force_version is None:
+        die("{0} is already deployed. Increment the version number to deploy "
+            "a new release.".format(artifact.requirement(version)))
+
+    existing = facts.parse_files(state['files'])
+    files = {}
+    for destination, content in sorted(rendered.items()):
+        before = state.checksum(destination)
+        after = hashlib.sha256(content).hexdigest()
+        files[destination] = {'before': before, 'after': after}
+        if before == after:
+            continue
+        if before == '?':
+            files[destination]['diff'] = None
+            btw("{0} isn't readable, it will be rewritten".format(
+                destination))
+        else:
+            files[destination]['diff'] = unified_diff(
+                existing.get(destination), content, destination)
+            fyi(files[destination]['diff'])
+
+    def changed(destination):
+        planned = files[destination]
+        return planned['before'] != planned['after']
+
+    steps = []
+    local, remote = package_manifests(artifact, state)
+    uploads = sync.changes(local, remote)
+    if uploads:
+        steps.append("upload {0} package(s): {1}".format(len(uploads),
+                                                         ', '.join(uploads)))
+    if version in state['releases'].split():
+        steps.append("reuse the existing {0} release".format(version))
+    else:
+        dependencies, fingerprint = dependencies_fingerprint(artifact, local)
+        if fingerprint is None:
+            steps.append("build unpinned dependencies: {0}".format(
+                ', '.join(dependencies)))
+        elif fingerprint in state['envs'].split():
+            steps.append("clone cached dependencies {0}".format(fingerprint))
+        else:
+            steps.append("build dependencies {0}: {1}".format(
+                fingerprint, ', '.join(dependencies) or 'none'))
+        steps.append("install {0} in releases/{1}".format(
+            artifact.requirement(version), version))
+
+    variables = set(env.get('env', {})) | set(['MEDIA_ROOT', 'STATIC_ROOT',
+                                               'REDIS_URL'])
+    if env.pgbouncer:
+        variables.add('DATABASE_URL')
+    removed = set(state['envdir'].split()) - variables
+    steps.append("write {0} envdir variable(s){1}".format(
+        len(variables), ', remove {0}'.format(', '.join(sorted(removed)))
+        if removed else ''))
+
+    if caches.allocations(state).get(env.http_host) != env.cache:
+        steps.append("record redis DB {0} ({1})".format(env.cache,
+                                                       env.cache_reason))
+    if state['database'] != env.http_host:
+        steps.append("create the {0} database".format(env.http_host))
+    if env.pgbouncer and changed('{0}/{1}.ini'.format(POOLS, env.http_host)):
+        steps.append("set the PgBouncer pool to {0} connections".format(
+            env.db_pool_size))
+    # Unpinned dependencies are resolved when the release is built, the
+    # existing release or the current one tells what they'll likely be
+    resolved = None
+    source = version if version in state['releases'].split() else current
+    if dependencies_fingerprint(artifact, local)[1] is None and source:
+        resolved = resolved_dependencies('{0}/releases/{1}/env'.format(
+            env.bundle_root, source))
+    schema = schema_fingerprint(artifact, local, resolved)
+    if schema is None:
+        steps.append("syncdb and migrations unless the resolved dependencies "
+                     "and the schema are unchanged")
+    elif schema == state['schema'] and state['database'] == env.http_host:
+        steps.append("skip syncdb and migrations, schema {0} "
+                     "unchanged{1}".format(schema, ', if the unpinned '
+                                           'dependencies resolve like in '
+                                           + source if source != version
+                                           and resolved is not None else ''))
+    elif 'migrations' in env:
+        steps.append("run {0} migrations (schema {1} -> {2})".format(
+            env.migrations, state['schema'] or 'none', schema))
+    else:
+        steps.append("syncdb (schema {0} -> {1})".format(
+            state['schema'] or 'none', schema))
+    if env.staticfiles:
+        steps.append("collect static files, copy the changed ones")
+    if changed(env.bundle_root + '/conf/nginx.conf'):
+        steps.append("reload nginx")
+    if changed(env.bundle_root + '/conf/supervisor.conf') or (
+            'rq' in env and env.rq):
+        steps.append("supervisorctl update")
+    steps.append("switch current from {0} to {1}".format(current or 'none',
+                                                         version))
+    steps.append("reload gunicorn")
+    if env.get('microcache'):
+        steps.append("purge the nginx cache")
+    steps.append("keep the {0} latest releases".format(
+        int(env.get('keep_releases', 5))))
+
+    btw("Plan for {0} ({1} -> {2}):".format(env.http_host, current or 'none',
+                                            version))
+    for destination in sorted(files):
+        if changed(destination):
+            btw("  update {0}".format(destination))
+    for step in steps:
+        btw("  {0}".format(step))
+
+    return {
+        'version': version,
+        'current': current,
+        'files': files,
+        'steps': steps,
+    }
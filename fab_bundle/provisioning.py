@@ -1,19 +1,40 @@
 """
 Provisioning tasks
 """
+import hashlib
+import json
+
+from io import BytesIO
 from textwrap import dedent
 
-from fabric.api import env, run, sudo, task, cd
-from fabric.context_managers import settings
-from fabric.contrib.files import exists
+from fabric.api import env, task, cd
+from fabric.decorators import runs_once, serial
 
-from .utils import template, mkdir, die, err, btw, yay
+from . import facts, sizing
+from .fleet import on_hosts
+from .render import render
+from .timing import phase, pipeline, run, sudo, put
+from .utils import template, die, err, btw, flag, yay
 
 
 @task
-def bootstrap():
-    """Sets up a server to be a bundle container"""
+@runs_once
+@serial
+def bootstrap(upgrade=False):
+    """
+    Sets up a server to be a bundle container. Steps whose inputs haven't
+    changed since the last run are skipped, packages are only upgraded with
+    bootstrap:upgrade=1.
+    """
+    on_hosts(bootstrap_host, flag(upgrade))
+
+
+def bootstrap_host(upgrade=False):
+    """Sets up the current host to be a bundle container"""
     if env.user == 'root':
+        if env.parallel:
+            die("Bootstrapping as root needs a prompt, which isn't possible "
+                "when running in parallel. Run without -P.")
         run('apt-get update')
         run('apt-get install sudo')
         err("Please don't use root. I'll create a user for you.")
@@ -29,46 +50,55 @@ def bootstrap():
         run('chown -R %s:%s /home/%s/.ssh' % (name, name, name))
         die("""Now please use %s as username and run the bootstrap task again.""" % name)
 
+    state = facts.gather_host(package_list(), host_files())
+    provisioned = json.loads(state['provisioned'] or '{}')
+    # Steps return False when they had nothing to do
+    skipped = []
+
+    run('mkdir -p conf bin dbs .pip .fab-bundle')
     btw("Configuring firewal...")
-    iptables()
-    btw("Installing and upgrading packages...")
-    packages()
-    pip()
+    with phase('iptables'):
+        if not iptables(provisioned):
+            skipped.append('iptables')
+    btw("Installing packages...")
+    with phase('packages'):
+        if not packages(upgrade):
+            skipped.append('packages')
+    with phase('pip'):
+        if not pip():
+            skipped.append('pip')
     btw("Setting up postgres...")
-    postgres()
+    with phase('postgres'):
+        if not postgres(provisioned):
+            skipped.append('postgres')
+    if env.get('pgbouncer'):
+        btw("Setting up pgbouncer...")
+        with phase('pgbouncer'):
+            if not pgbouncer():
+                skipped.append('pgbouncer')
+    btw("Limiting redis memory...")
+    with phase('redis'):
+        if not redis():
+            skipped.append('redis')
     btw("Installing maintenance cron jobs")
-    cron()
-    btw("Enabling nginx and supervisor")
-    nginx()
-    supervisor()
+    with phase('cron'):
+        if not cron():
+            skipped.append('cron')
+    btw("Enabling the services")
+    with phase('services'):
+        if not services():
+            skipped.append('services')
+
+    put(BytesIO(json.dumps(provisioned, indent=2, sort_keys=True)),
+        '.fab-bundle/provisioning.json')
+    if skipped:
+        btw("Already up to date: {0}".format(', '.join(skipped)))
     ip = run('curl http://ifconfig.me/')
     yay("Bundle container up and running at %s." % ip)
 
 
-def iptables():
-    """
-    Makes sure only HTTP, HTTPS and SSH are available from the outside.
-    """
-    conf = '/home/%(user)s/conf' % env
-    mkdir(conf)
-    iptables_conf = conf + '/iptables.rules'
-    changed = template('iptables.rules', iptables_conf)
-    if changed:
-        sudo('/sbin/iptables-restore --table=nat < %s' % iptables_conf)
-
-    # Automate for reboots
-    pre_up = '/etc/network/if-pre-up.d/iptables'
-    if not exists(pre_up):
-        template('iptables', pre_up, use_sudo=True)
-    sudo('chmod +x %s' % pre_up)
-
-
-def packages():
-    """
-    Installs all the required debian packages.
-    """
-    sudo('apt-get update')
-    sudo('apt-get -y upgrade')
+def package_list():
+    """The debian packages a bundle container needs"""
     if not 'pg_version' in env:
         env.pg_version = '9.1'
     packages = [
@@ -97,7 +127,10 @@ def packages():
         'redis-server',
 
         'curl',
+        'pigz',
     ]
+    if env.get('pgbouncer'):
+        packages.append('pgbouncer')
     if 'gis' not in env or env.gis is not False:
         packages += [
             'postgis',
@@ -106,48 +139,120 @@ def packages():
             'libproj-dev',
             'libgeos-dev',
         ]
-    sudo('apt-get -y install %s' % ' '.join(packages))
+    return packages
+
+
+def host_files():
+    """Files installed by bootstrap whose checksums are gathered upfront"""
+    home = '/home/%(user)s' % env
+    return [
+        home + '/conf/iptables.rules',
+        '/etc/network/if-pre-up.d/iptables',
+        '.pip/pip.conf',
+        home + '/bin/backup_dbs.py',
+        home + '/bin/check.py',
+        home + '/bin/logstats.py',
+        '/etc/cron.d/fabbundle',
+        '/etc/pgbouncer/pgbouncer.ini',
+        '/etc/redis/fab-bundle.conf',
+    ]
+
+
+def digest(source):
+    """SHA-256 of a rendered template, as recorded in the provisioning state"""
+    return hashlib.sha256(render(source)).hexdigest()
+
+
+def iptables(provisioned):
+    """
+    Makes sure only HTTP, HTTPS and SSH are available from the outside.
+    """
+    iptables_conf = '/home/%(user)s/conf/iptables.rules' % env
+    changed = template('iptables.rules', iptables_conf)
+    if changed or provisioned.get('iptables') != digest('iptables.rules'):
+        sudo('/sbin/iptables-restore --table=nat < %s' % iptables_conf)
+        provisioned['iptables'] = digest('iptables.rules')
+        changed = True
+
+    # Automate for reboots
+    pre_up = '/etc/network/if-pre-up.d/iptables'
+    if template('iptables', pre_up, use_sudo=True):
+        sudo('chmod +x %s' % pre_up)
+        changed = True
+    return changed
+
+
+def packages(upgrade=False):
+    """
+    Installs the required debian packages that are missing, and upgrades
+    all of them if ``upgrade`` is set.
+    """
+    state = facts.current()
+    packages = package_list()
+    installed = set(state['installed'].split())
+    missing = [package for package in packages if package not in installed]
+    if not missing and not upgrade:
+        return False
+
+    sudo('apt-get update')
+    if upgrade:
+        sudo('apt-get -y upgrade')
+    if missing:
+        btw("Installing {0}".format(', '.join(missing)))
+        sudo('apt-get -y install %s' % ' '.join(missing))
+    state.invalidate('installed', 'libs', 'pg_version', 'postgis',
+                     'running')
 
     # Fixes so that PIL recognizes the correct libraries. f7u12.
+    libs = state['libs'].split()
+    links = []
     for lib in ['libz', 'libjpeg', 'libfreetype']:
-        if not exists('/usr/lib/%s.so' % lib):
-            for source in ('/usr/lib/i386-linux-gnu/%s.so' % lib,
-                           '/usr/lib/x86_64-linux-gnu/%s.so' % lib):
-                if exists(source):
-                    with cd('/usr/lib'):
-                        sudo('ln -s %s .' % source)
-                    break
+        if '/usr/lib/%s.so' % lib in libs:
+            continue
+        for source in ('/usr/lib/i386-linux-gnu/%s.so' % lib,
+                       '/usr/lib/x86_64-linux-gnu/%s.so' % lib):
+            if source in libs:
+                links.append(source)
+                break
+    if links:
+        with cd('/usr/lib'):
+            sudo('ln -s %s .' % ' '.join(links))
+    return True
 
 
 def pip():
-    run('mkdir -p .pip')
-    template('pip.conf', '.pip/pip.conf')
+    return template('pip.conf', '.pip/pip.conf')
 
 
-def postgres():
+def postgres(provisioned):
     """
     Configures Postgres.
     """
+    changed = False
+
     # Set up daily DB dumps
-    run('mkdir -p dbs')
-    run('mkdir -p bin')
     backup = '/home/%(user)s/bin/backup_dbs.py' % env
-    template('backup_dbs.py', backup)
-    run('chmod +x %s' % backup)
+    if template('backup_dbs.py', backup):
+        run('chmod +x %s' % backup)
+        changed = True
 
-    pg_version = run('ls /etc/postgresql').split()[0]
-    pg_hba = '/etc/postgresql/%s/main/pg_hba.conf' % pg_version
+    state = facts.current()
+    if provisioned.get('pg_hba') != digest('pg_hba.conf'):
+        pg_version = state['pg_version'].split()[0]
+        pg_hba = '/etc/postgresql/%s/main/pg_hba.conf' % pg_version
+        if template('pg_hba.conf', pg_hba, use_sudo=True):
+            btw("Updated pg_hba.conf, reloading postgres...")
+            sudo('/etc/init.d/postgresql restart')
+        provisioned['pg_hba'] = digest('pg_hba.conf')
+        changed = True
 
-    changed = template('pg_hba.conf', pg_hba, use_sudo=True)
-    if changed:
-        btw("Updated pg_hba.conf, reloading postgres...")
-        template('pg_hba.conf', pg_hba, use_sudo=True)
-        sudo('/etc/init.d/postgresql restart')
     if 'gis' in env and env.gis is False:
-        return
-    templates = run('psql -U postgres -l|grep template')
-    if 'template_postgis' in templates:
-        return
+        return changed
+    if provisioned.get('postgis'):
+        return changed
+    provisioned['postgis'] = True
+    if state['postgis'] not in ('', '0'):
+        return True
     btw("Creating a spatial template...")
     path = run('pg_config --sharedir') + '/contrib/postgis-1.5'
 
@@ -159,33 +264,75 @@ def postgres():
     run('psql -U postgres -d template_postgis -c "GRANT ALL ON geometry_columns TO PUBLIC;"')
     run('psql -U postgres -d template_postgis -c "GRANT ALL ON geography_columns TO PUBLIC;"')
     run('psql -U postgres -d template_postgis -c "GRANT ALL ON spatial_ref_sys TO PUBLIC;"')
+    return True
+
+
+def pgbouncer():
+    """
+    Configures PgBouncer in transaction pooling mode. Bundles add their
+    database to it when they're deployed.
+    """
+    sudo('mkdir -p /etc/pgbouncer/databases.d && '
+         'touch /etc/pgbouncer/databases.ini')
+    if not template('pgbouncer.ini', '/etc/pgbouncer/pgbouncer.ini',
+                    use_sudo=True):
+        return False
+    sudo("test ! -f /etc/default/pgbouncer || "
+         "sed -i 's/^START=0/START=1/' /etc/default/pgbouncer")
+    sudo('/etc/init.d/pgbouncer restart')
+    return True
 
 
-def nginx():
+def redis():
     """
-    Make sure nginx is started by default.
+    Sets redis' maxmemory from the host's RAM, or ``env.redis_maxmemory`` in
+    MB. Only keys with an expiry are evicted so that a bundle's cache can't
+    evict the rq queues.
     """
-    with settings(warn_only=True):
-        res = sudo('/etc/init.d/nginx status')
-        if 'could not access PID file' in res:
-            sudo('/etc/init.d/nginx start')
+    if not 'redis_maxmemory' in env:
+        memory = int(facts.current()['memory'] or 0) // 1024
+        env.redis_maxmemory = sizing.redis_memory(memory)
+    conf = '/etc/redis/fab-bundle.conf'
+    if not template('redis.conf', conf, use_sudo=True):
+        return False
+    include = 'include {0}'.format(conf)
+    sudo("grep -qx '{0}' /etc/redis/redis.conf || "
+         "echo '{0}' >> /etc/redis/redis.conf".format(include))
+    # Applied live, a restart would drop what wasn't saved
+    sudo('redis-cli config set maxmemory {0}mb && '
+         'redis-cli config set maxmemory-policy volatile-lru'.format(
+             env.redis_maxmemory))
+    return True
 
 
-def supervisor():
+def services():
     """
-    Make sure supervisor is started by default.
+    Make sure nginx, supervisor and pgbouncer are started.
     """
-    res = sudo('/etc/init.d/supervisor status || true')
-    if 'not running' in res:
-        sudo('/etc/init.d/supervisor start')
+    running = facts.current()['running'].split()
+    started = False
+    services = ['nginx', 'supervisor']
+    if env.get('pgbouncer'):
+        services.append('pgbouncer')
+    with pipeline() as commands:
+        for service in services:
+            if service not in running:
+                commands.sudo('/etc/init.d/%s start' % service)
+                started = True
+    return started
 
 
 def cron():
-    health_check = '/home/%(user)s/bin/check.py' % env
-    template('check.py', health_check)
-    run('chmod +x %s' % health_check)
+    changed = False
+    for script in ('check.py', 'logstats.py'):
+        path = '/home/%s/bin/%s' % (env.user, script)
+        if template(script, path):
+            run('chmod +x %s' % path)
+            changed = True
 
     target = '/etc/cron.d/fabbundle'
-    template('admincron', target, use_sudo=True)
-    sudo('chown root:root %s' % target)
-    sudo('chmod 644 %s' % target)
+    if template('admincron', target, use_sudo=True):
+        sudo('chown root:root %s' % target)
+        sudo('chmod 644 %s' % target)
+        changed = True
+    return changed
@@ -0,0 +1,51 @@
+"""
+Rendering the templates shipped in ``fab_bundle/templates``
+"""
+import os
+
+from fabric.api import env
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+
+TEMPLATE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                            'templates')
+
+# Shared by all renders, compiled templates are cached on disk between runs
+jinja = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+                    bytecode_cache=FileSystemBytecodeCache())
+
+_variables = {}
+_rendered = {}
+
+
+def variables(source):
+    """Names of the context variables used by a template"""
+    if source not in _variables:
+        text = jinja.loader.get_source(jinja, source)[0]
+        _variables[source] = frozenset(
+            meta.find_undeclared_variables(jinja.parse(text)))
+    return _variables[source]
+
+
+def render(source, **context):
+    """
+    Renders a template with env, updated with ``context``, as context.
+
+    The output is memoised on the values of the variables the template
+    actually uses.
+    """
+    context = dict(env, **context)
+    key = (source, repr(sorted((name, context.get(name))
+                               for name in variables(source))))
+    if key not in _rendered:
+        template = jinja.get_template(source)
+        _rendered[key] = template.render(**context).encode('utf-8')
+    return _rendered[key]
+
+
+def render_all(files):
+    """
+    Renders a list of (source, destination, context) in one pass, returns a
+    dict of destination -> content.
+    """
+    return dict((destination, render(source, **context))
+                for source, destination, context in files)
@@ -0,0 +1,94 @@
+"""
+Sizing gunicorn and rq from the resources of the host
+"""
+from fabric.api import env
+
+from .utils import btw
+
+# Rough memory footprint of a gunicorn worker, in MB
+WORKER_MEMORY = 150
+# Share of the RAM redis may use before evicting cache entries
+REDIS_SHARE = 8
+
+
+def bundle_count(conf_files, bundle_name):
+    """
+    Counts the bundles on the host from the supervisor programs, including
+    the one being deployed.
+    """
+    bundles = set()
+    for name in conf_files.split():
+        if name.endswith('.conf') and '_worker' not in name and \
+                '_autoscaler' not in name:
+            bundles.add(name[:-len('.conf')])
+    bundles.add(bundle_name)
+    return len(bundles)
+
+
+def compute(cpus, memory, bundles, rq=False):
+    """
+    Computes the settings for a bundle sharing ``cpus`` cores and ``memory``
+    MB of RAM with ``bundles - 1`` other bundles. Returns a list of
+    (setting, value, reason) tuples.
+    """
+    worker_memory = int(env.get('worker_memory', WORKER_MEMORY))
+    # Half of the memory goes to gunicorn, the rest to postgres, redis, etc.
+    memory_share = memory // 2 // bundles
+
+    by_cpu = max(1, (2 * cpus + 1) // bundles)
+    by_memory = max(1, memory_share // worker_memory)
+    workers = min(by_cpu, by_memory)
+    settings = [('workers', workers,
+                 '(2 x {0} CPUs + 1) / {1} bundles = {2}, {3}MB of RAM for '
+                 '{4}MB workers allows {5}'.format(
+                     cpus, bundles, by_cpu, memory_share, worker_memory,
+                     by_memory))]
+
+    # Each gevent connection costs some memory, scale down on small hosts
+    per_worker = memory_share // workers
+    connections = max(100, min(1000, per_worker * 2))
+    settings.append(('worker_connections', connections,
+                     '{0}MB per worker, 2 connections per MB between 100 '
+                     'and 1000'.format(per_worker)))
+
+    settings.append(('max_requests', 1000,
+                     'recycles workers to contain memory leaks'))
+    settings.append(('max_requests_jitter', 100,
+                     "10% so that workers don't restart all at once"))
+
+    if rq:
+        rq_workers = max(1, cpus // bundles)
+        settings.append(('rq_workers', rq_workers,
+                         '{0} CPUs / {1} bundles'.format(cpus, bundles)))
+    return settings
+
+
+def autosize(state):
+    """
+    Sets the gunicorn and rq settings that aren't set explicitly in env from
+    the host's CPUs, memory and number of bundles, and explains them.
+    """
+    cpus = int(state['cpus'] or 1)
+    memory = int(state['memory'] or 0) // 1024
+    bundles = bundle_count(state['bundles'], env.http_host)
+    rq = 'rq' in env and env.rq
+
+    btw("Sizing for {0} CPUs, {1}MB of RAM and {2} bundle(s):".format(
+        cpus, memory, bundles))
+    for name, value, reason in compute(cpus, memory, bundles, rq):
+        if name == 'rq_workers':
+            if 'workers' in env.rq:
+                btw("  rq_workers = {0} (env.rq)".format(env.rq['workers']))
+                continue
+            env.rq = dict(env.rq, workers=value)
+        elif name in env:
+            btw("  {0} = {1} (env.{0})".format(name, env[name]))
+            continue
+        else:
+            env[name] = value
+        btw("  {0} = {1}: {2}".format(name, value, reason))
+
+
+def redis_memory(memory):
+    """Redis' maxmemory in MB for a host with ``memory`` MB of RAM"""
+    return max(64, memory // REDIS_SHARE)
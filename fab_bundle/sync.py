@@ -0,0 +1,106 @@
+"""
+Syncing local packages to a bundle's ``packages`` directory
+"""
+import os
+import tarfile
+import tempfile
+import time
+
+from .artifacts import file_checksum
+from .timing import run, put
+from .utils import btw, yay
+
+MANIFEST = '.manifest'
+
+
+def local_manifest(paths, checksums=None):
+    """
+    Maps file names to (size, sha256, local path). ``checksums`` holds
+    already known checksums, keyed by path.
+    """
+    checksums = checksums or {}
+    manifest = {}
+    for path in paths:
+        sha256 = checksums.get(path) or file_checksum(path)
+        manifest[os.path.basename(path)] = (os.path.getsize(path), sha256,
+                                            path)
+    return manifest
+
+
+def remote_manifest(sizes, manifest):
+    """
+    Maps remote file names to (size, sha256). ``sizes`` is a "size name"
+    listing of the remote files, ``manifest`` the content of the manifest
+    written by the last sync. Files that changed size since then have no
+    known checksum.
+    """
+    recorded = {}
+    for line in manifest.splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+            recorded[parts[2]] = (int(parts[1]), parts[0])
+
+    files = {}
+    for line in sizes.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            continue
+        size, name = int(parts[0]), parts[1]
+        sha256 = None
+        if name in recorded and recorded[name][0] == size:
+            sha256 = recorded[name][1]
+        files[name] = (size, sha256)
+    return files
+
+
+def changes(local, remote):
+    """Names of the ``local`` files missing or different in ``remote``"""
+    return sorted(name for name, (size, sha256, _) in local.items()
+                  if remote.get(name) != (size, sha256))
+
+
+def sync(local, remote, destination):
+    """
+    Uploads the files from the ``local`` manifest that are missing or
+    different in the ``remote`` one to the ``destination`` directory, as a
+    single compressed tarball. Returns the names of the uploaded files.
+    """
+    changed = changes(local, remote)
+    if not changed:
+        return changed
+
+    start = time.time()
+    lines = []
+    for name, (size, sha256) in sorted(remote.items()):
+        if name not in local and sha256 is not None:
+            lines.append('{0} {1} {2}'.format(sha256, size, name))
+    for name, (size, sha256, _) in sorted(local.items()):
+        lines.append('{0} {1} {2}'.format(sha256, size, name))
+
+    fd, manifest_path = tempfile.mkstemp()
+    tarball = tempfile.NamedTemporaryFile(suffix='.tar.gz')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        archive = tarfile.open(tarball.name, 'w:gz')
+        for name in changed:
+            archive.add(local[name][2], arcname=name)
+        archive.add(manifest_path, arcname=MANIFEST)
+        archive.close()
+
+        raw = sum(local[name][0] for name in changed)
+        compressed = os.path.getsize(tarball.name)
+        btw("Uploading {0} file(s), {1} KB ({2} KB compressed)...".format(
+            len(changed), raw / 1024, compressed / 1024))
+        remote_tarball = '{0}.tar.gz'.format(destination.rstrip('/'))
+        put(tarball.name, remote_tarball)
+        run('mkdir -p {0} && tar -xzf {1} -C {0} && rm {1}'.format(
+            destination, remote_tarball))
+    finally:
+        tarball.close()
+        os.remove(manifest_path)
+
+    elapsed = time.time() - start
+    yay("Synced {0} file(s) in {1:.1f}s ({2} KB/s)".format(
+        len(changed), elapsed, int(compressed / 1024 / max(elapsed, 0.001))))
+    return changed
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Starts and stops the rq workers of {{ http_host }} according to the length
+of its queues.
+
+Workers are added as soon as there are more than JOBS_PER_WORKER jobs
+queued per running worker. They're removed one at a time, once the queues
+have been short enough for SCALE_DOWN_DELAY seconds to be handled by one
+worker less at half its capacity.
+"""
+import datetime
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+BUNDLE = '{{ http_host }}'
+REDIS = ('localhost', 6379)
+DB = {{ cache }}
+QUEUES = ['high', 'default', 'low']
+MIN_WORKERS = {{ rq.min_workers }}
+MAX_WORKERS = {{ rq.workers }}
+JOBS_PER_WORKER = {{ rq.jobs_per_worker or 50 }}
+SCALE_DOWN_DELAY = {{ rq.scale_down_delay or 300 }}
+POLL = 5
+STATUS = '{{ bundle_root }}/run/autoscaler.json'
+
+WORKER = re.compile(r'^%s_worker(\d+)\s+(\w+)' % re.escape(BUNDLE))
+STARTED = ('RUNNING', 'STARTING', 'BACKOFF')
+
+
+class RedisError(Exception):
+    pass
+
+
+def log(message):
+    sys.stdout.write('%s %s\n' % (datetime.datetime.now().isoformat(),
+                                  message))
+    sys.stdout.flush()
+
+
+def command(*args):
+    """A command in the redis protocol"""
+    return '*%d\r\n%s' % (len(args), ''.join(
+        '$%d\r\n%s\r\n' % (len(arg), arg) for arg in args))
+
+
+def reply(f):
+    line = f.readline()
+    if not line:
+        raise RedisError('connection closed')
+    if line[0] == '-':
+        raise RedisError(line[1:].strip())
+    if line[0] == ':':
+        return int(line[1:])
+    return line[1:].strip()
+
+
+def queue_lengths():
+    """Number of jobs in each queue, in a single round trip to redis"""
+    sock = socket.create_connection(REDIS, 5)
+    try:
+        sock.sendall(command('SELECT', str(DB)) + ''.join(
+            command('LLEN', 'rq:queue:' + queue) for queue in QUEUES))
+        f = sock.makefile('rb')
+        reply(f)
+        return dict((queue, reply(f)) for queue in QUEUES)
+    finally:
+        sock.close()
+
+
+def supervisorctl(*args):
+    process = subprocess.Popen(('supervisorctl',) + args,
+                               stdout=subprocess.PIPE)
+    return process.communicate()[0]
+
+
+def started_workers():
+    """Ids of the workers supervisor has started"""
+    ids = []
+    for line in supervisorctl('status').splitlines():
+        match = WORKER.match(line)
+        if match and match.group(2) in STARTED:
+            ids.append(int(match.group(1)))
+    return sorted(ids)
+
+
+def scale(started, count, reason):
+    """Starts or stops workers so that ``count`` of them are running"""
+    if count > len(started):
+        ids = [worker_id for worker_id in range(MAX_WORKERS)
+               if worker_id not in started][:count - len(started)]
+        action = 'start'
+    else:
+        ids = started[count:]  # The last ones started
+        action = 'stop'
+    log('%s -> %s workers: %s' % (len(started), count, reason))
+    supervisorctl(action, *['%s_worker%s' % (BUNDLE, worker_id)
+                            for worker_id in ids])
+    return '%s %s worker(s): %s' % (action, len(ids), reason)
+
+
+def write_status(status):
+    tmp = STATUS + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=2, sort_keys=True)
+    os.rename(tmp, STATUS)
+
+
+def main():
+    log('Scaling %s workers between %s and %s, %s jobs per worker' % (
+        BUNDLE, MIN_WORKERS, MAX_WORKERS, JOBS_PER_WORKER))
+    quiet_since = None
+    status = {'min': MIN_WORKERS, 'max': MAX_WORKERS, 'decision': None,
+              'decided': None}
+    while True:
+        try:
+            queues = queue_lengths()
+            started = started_workers()
+        except (socket.error, RedisError, OSError) as e:
+            log('Error: %s' % e)
+            time.sleep(POLL)
+            continue
+
+        now = time.time()
+        depth = sum(queues.values())
+        count = len(started)
+        wanted = int(math.ceil(depth / float(JOBS_PER_WORKER)))
+        wanted = min(MAX_WORKERS, max(MIN_WORKERS, wanted))
+        if wanted > count:
+            status['decision'] = scale(started, wanted,
+                                       '%s jobs queued' % depth)
+            status['decided'] = now
+            count = wanted
+            quiet_since = None
+        elif wanted < count and (
+                count > MAX_WORKERS or
+                depth <= (count - 1) * JOBS_PER_WORKER // 2):
+            quiet_since = quiet_since or now
+            if now - quiet_since >= SCALE_DOWN_DELAY:
+                status['decision'] = scale(
+                    started, count - 1, '%s jobs queued for %ss' % (
+                        depth, int(now - quiet_since)))
+                status['decided'] = now
+                count -= 1
+                quiet_since = now  # Wait as long before the next one
+        else:
+            quiet_since = None
+
+        status.update(workers=count, queues=queues, depth=depth,
+                      updated=now)
+        write_status(status)
+        time.sleep(POLL)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
+import zlib
 
-KEEP = 7  # number od days to keep
+KEEP = {{ backup_keep or 7 }}  # number of days to keep
 BACKUP_DIR = '/home/{{ user }}/dbs'
+JOBS = {{ backup_jobs or 2 }}  # number of databases dumped at once
+# Databases larger than this (in MB) are dumped in directory format, with
+# DUMP_JOBS parallel jobs each
+LARGE_DB = {{ backup_large_db or 1024 }}
+DUMP_JOBS = {{ backup_dump_jobs or 2 }}
+# 'full' writes a compressed dump per database and day. 'dedup' splits dumps
+# into content-defined chunks stored once in CHUNKS_DIR, each dump being an
+# index of its chunks.
+MODE = '{{ backup_mode or "full" }}'
+CHUNKS_DIR = os.path.join(BACKUP_DIR, 'chunks')
+# Chunks end after a line whose CRC has its CHUNK_BITS lowest bits unset,
+# as long as they're between MIN_CHUNK and MAX_CHUNK bytes.
+CHUNK_BITS = 12
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
 IGNORE_DBS = (
     'template0',
     'template1',
@@ -26,30 +50,266 @@ def run(command):
     return out
 
 
+def databases():
+    """
+    Returns the (name, size in bytes) of the databases to back up.
+    """
+    out = run('psql -U postgres -At -F " " -c "SELECT datname, '
+              'pg_database_size(datname) FROM pg_database '
+              'WHERE NOT datistemplate"')
+    dbs = []
+    for line in out.splitlines():
+        name, size = line.rsplit(' ', 1)
+        if name not in IGNORE_DBS:
+            dbs.append((name, int(size)))
+    return dbs
+
+
+def compressor():
+    """pigz if it's installed, gzip otherwise"""
+    if run('which pigz').strip():
+        return 'pigz -p %s' % multiprocessing.cpu_count()
+    return 'gzip'
+
+
+def checksum(path):
+    """
+    SHA-256 of a file, or of the checksums of the files in a directory.
+    """
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(path)):
+            digest.update('%s %s\n' % (name, checksum(os.path.join(path,
+                                                                   name))))
+        return digest.hexdigest()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def disk_usage(path):
+    if os.path.isdir(path):
+        return sum(disk_usage(os.path.join(path, name))
+                   for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def chunks(stream):
+    """
+    Splits a stream into chunks on line boundaries chosen from the content
+    of the lines, so that a change in the data only affects the chunks around
+    it.
+    """
+    mask = (1 << CHUNK_BITS) - 1
+    chunk = []
+    length = 0
+    for line in iter(lambda: stream.readline(MAX_CHUNK), ''):
+        chunk.append(line)
+        length += len(line)
+        if length >= MAX_CHUNK or (length >= MIN_CHUNK and
+                                   not zlib.crc32(line) & mask):
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def chunk_path(digest):
+    return os.path.join(CHUNKS_DIR, digest[:2], digest)
+
+
+def store(chunk):
+    """
+    Stores a chunk unless it's already there. Returns its digest and the
+    number of bytes written.
+    """
+    digest = hashlib.sha256(chunk).hexdigest()
+    path = chunk_path(digest)
+    if os.path.exists(path):
+        return digest, 0
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:  # created by another dump meanwhile
+            pass
+    data = zlib.compress(chunk, 6)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+    return digest, len(data)
+
+
+def dump_chunked(name, backup_dir, date):
+    """
+    Streams a dump into the chunk store and writes its index.
+    """
+    file_name = '%s-%s.index' % (name, date)
+    process = subprocess.Popen(['pg_dump', '-U', 'postgres', name],
+                               stdout=subprocess.PIPE)
+    digest = hashlib.sha256()
+    size = new = stored = 0
+    with open(os.path.join(backup_dir, file_name), 'w') as index:
+        for chunk in chunks(process.stdout):
+            digest.update(chunk)
+            chunk_digest, written = store(chunk)
+            index.write(chunk_digest + '\n')
+            size += len(chunk)
+            if written:
+                new += len(chunk)
+                stored += written
+    return {
+        'file': file_name,
+        'status': process.wait(),
+        'size': stored,
+        'dump_size': size,
+        'new_data': new,
+        'dedup_ratio': round(float(size) / new, 2) if new else None,
+        'sha256': digest.hexdigest(),
+    }
+
+
+def restore(index):
+    """
+    Writes the dump described by an index to stdout.
+    """
+    with open(index) as f:
+        for line in f:
+            with open(chunk_path(line.strip()), 'rb') as chunk:
+                sys.stdout.write(zlib.decompress(chunk.read()))
+
+
+def collect():
+    """
+    Removes the chunks that aren't referenced by any index anymore.
+    """
+    if not os.path.isdir(CHUNKS_DIR):
+        return 0
+    referenced = set()
+    for directory, _, files in os.walk(BACKUP_DIR):
+        if directory.startswith(CHUNKS_DIR):
+            continue
+        for name in files:
+            if name.endswith('.index'):
+                with open(os.path.join(directory, name)) as f:
+                    referenced.update(line.strip() for line in f)
+    removed = 0
+    for directory, _, files in os.walk(CHUNKS_DIR):
+        for name in files:
+            if name not in referenced:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+    return removed
+
+
+def dump(args):
+    """
+    Dumps a database, returns its manifest entry.
+    """
+    name, size, backup_dir, date, compress = args
+    start = time.time()
+    if MODE == 'dedup':
+        entry = dump_chunked(name, backup_dir, date)
+        duration = time.time() - start
+        entry.update({
+            'database': name,
+            'database_size': size,
+            'duration': round(duration, 2),
+            'throughput': int(entry['dump_size'] / max(duration, 0.001)),
+        })
+        return entry
+
+    if size >= LARGE_DB * 1024 * 1024:
+        file_name = '%s-%s.dir' % (name, date)
+        cmd = 'pg_dump -U postgres -Fd -j %s -f %s/%s %s' % (
+            DUMP_JOBS, backup_dir, file_name, name)
+    else:
+        file_name = '%s-%s.sql.gz' % (name, date)
+        cmd = 'pg_dump -U postgres %s | %s > %s/%s' % (name, compress,
+                                                       backup_dir, file_name)
+    status = subprocess.call(['bash', '-o', 'pipefail', '-c', cmd])
+    path = os.path.join(backup_dir, file_name)
+
+    entry = {
+        'database': name,
+        'database_size': size,
+        'file': file_name,
+        'status': status,
+        'duration': round(time.time() - start, 2),
+    }
+    if status == 0:
+        entry['size'] = disk_usage(path)
+        entry['sha256'] = checksum(path)
+    return entry
+
+
+def prune():
+    """
+    Removes the dated backup directories older than KEEP days.
+    """
+    limit = datetime.date.today() - datetime.timedelta(days=KEEP)
+    for name in os.listdir(BACKUP_DIR):
+        try:
+            date = datetime.datetime.strptime(name, '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        if date < limit:
+            shutil.rmtree(os.path.join(BACKUP_DIR, name))
+
+
 def dbs():
+    start = time.time()
     yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
     yesterday = yesterday.strftime('%Y-%m-%d')
     backup_dir = '%s/%s' % (BACKUP_DIR, yesterday)
     run('mkdir -p %s' % backup_dir)
 
-    db_list = run('psql -U postgres -l')
-    for line in db_list.split('\n')[3:-3]:
-        line = line[1:]
-        if line.startswith(' '):
-            continue
-        db_name = line.split()[0]
-        if db_name in IGNORE_DBS:
-            continue
+    compress = compressor()
+    # Largest first so they don't end up running alone at the end
+    jobs = [(name, size, backup_dir, yesterday, compress)
+            for name, size in sorted(databases(), key=lambda db: -db[1])]
+    pool = multiprocessing.Pool(JOBS)
+    entries = pool.map(dump, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+
+    manifest = {
+        'date': yesterday,
+        'mode': MODE,
+        'started': datetime.datetime.fromtimestamp(start).isoformat(),
+        'size': sum(entry.get('size', 0) for entry in entries),
+        'dumps': entries,
+    }
+    if MODE == 'dedup':
+        dumped = sum(entry['dump_size'] for entry in entries)
+        new = sum(entry['new_data'] for entry in entries)
+        manifest.update({
+            'dump_size': dumped,
+            'new_data': new,
+            'dedup_ratio': round(float(dumped) / new, 2) if new else None,
+            'throughput': int(dumped / max(time.time() - start, 0.001)),
+        })
+
+    prune()
+    if MODE == 'dedup':
+        manifest['collected_chunks'] = collect()
 
-        file_name = '%s-%s.sql.gz' % (db_name, yesterday)
-        cmd = 'pg_dump -U postgres %s | gzip > %s/%s' % (db_name, backup_dir,
-                                                         file_name)
-        run(cmd)
+    manifest['duration'] = round(time.time() - start, 2)
+    with open(os.path.join(backup_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
 
-    old_dirs = run('ls %s' % BACKUP_DIR).strip().split('\n')[:-KEEP]
-    for old_dir in old_dirs:
-        run('rm -rf %s/%s' % (BACKUP_DIR, old_dir))
+    failed = [entry['database'] for entry in entries if entry['status']]
+    if failed:
+        print >>sys.stderr, 'Backup failed for: %s' % ', '.join(failed)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    dbs()
+    if len(sys.argv) == 3 and sys.argv[1] == 'restore':
+        restore(sys.argv[2])
+    else:
+        dbs()
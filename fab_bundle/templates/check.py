@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import datetime
+import glob
+import json
+import os
+import re
 import smtplib
+import struct
 import subprocess
+import sys
+import time
 
 TO = '{{ admin }}'
 FROM = '{{ email.from }}'
@@ -11,6 +18,27 @@ SMTP_PORT = {{ email.port }}
 SMTP_USERNAME = '{{ email.user }}'
 SMTP_PASSWORD = '{{ email.password }}'
 SERVER_NAME = '{{ host_string }}'
+LOGSTATS = '/home/{{ user }}/bin/logstats.py'
+BUNDLES = '{{ bundle_root or "/home/%s/bundles" % user }}'
+# Redis DBs allocated to the bundles by deploy, one file per bundle
+REDIS_DBS = '/home/{{ user }}/.fab-bundle/redis'
+
+# Metrics are sampled every INTERVAL seconds by "check.py collect" (see the
+# cron). Each series is a ring of RETENTION (timestamp, value) records, the
+# slot of a record being derived from its timestamp.
+METRICS_DIR = '/home/{{ user }}/metrics'
+INTERVAL = 300
+RETENTION = 14 * 24 * 3600 // INTERVAL
+RECORD = struct.Struct('<If')
+CPU_STATE = os.path.join(METRICS_DIR, '.cpu.json')
+MB = 1024 * 1024.
+TICKS = os.sysconf('SC_CLK_TCK')
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+GUNICORN = re.compile(r'gunicorn: \w+ \[(.+?)\]')
+# postgres: [cluster: ]user database host activity
+POSTGRES = re.compile(r'^postgres: (?:\S+: )?\S+ (\S+) '
+                      r'(?:\[local\]|[\w.:-]+\(\d+\)|[\d.:a-f]+) ')
 
 
 def run(command):
@@ -26,19 +54,272 @@ def run(command):
     return out
 
 
+def processes():
+    """Yields the pid and command line of the running processes"""
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % pid) as f:
+                cmdline = f.read().replace('\0', ' ').strip()
+        except IOError:  # gone meanwhile
+            continue
+        if cmdline:
+            yield pid, cmdline
+
+
+def usage(pid):
+    """Resident memory in MB and CPU time in seconds of a process"""
+    with open('/proc/%s/stat' % pid) as f:
+        # Fields after the command name, which may contain spaces
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(TICKS)
+    return int(fields[21]) * PAGE / MB, cpu
+
+
+def bundle_of(cmdline):
+    """The bundle a gunicorn or rq process belongs to"""
+    match = GUNICORN.search(cmdline)
+    if match:
+        return match.group(1)
+    prefix = BUNDLES + '/'
+    if prefix in cmdline:
+        return cmdline.split(prefix, 1)[1].split('/', 1)[0]
+
+
+def backlogs():
+    """Connections waiting to be accepted on each bundle's socket"""
+    queues = {}
+    for line in run('ss -xln').splitlines():
+        parts = line.split()
+        if len(parts) > 4 and parts[4].startswith('/tmp/') and \
+                parts[4].endswith('.sock'):
+            queues[parts[4][len('/tmp/'):-len('.sock')]] = int(parts[2])
+    return queues
+
+
+def sample():
+    """Current values of the metrics, mostly read from /proc"""
+    values = {}
+    with open('/proc/loadavg') as f:
+        load = f.read().split()
+    for index, name in enumerate(['load.1', 'load.5', 'load.15']):
+        values[name] = float(load[index])
+
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            meminfo[name] = int(value.split()[0]) * 1024 / MB
+    available = meminfo.get('MemAvailable', meminfo['MemFree'] +
+                            meminfo['Buffers'] + meminfo['Cached'])
+    values['memory.used'] = meminfo['MemTotal'] - available
+    values['swap.used'] = meminfo['SwapTotal'] - meminfo['SwapFree']
+
+    rss, cpu, connections = {}, {}, {}
+    for pid, cmdline in processes():
+        match = POSTGRES.match(cmdline)
+        if match:
+            database = match.group(1)
+            connections[database] = connections.get(database, 0) + 1
+            continue
+        if 'redis-server' in cmdline.split(' ', 1)[0]:
+            name = 'redis'
+        else:
+            name = bundle_of(cmdline)
+            if name is None:
+                continue
+            name = 'bundle.%s' % name
+        try:
+            memory, seconds = usage(pid)
+        except IOError:
+            continue
+        rss[name] = rss.get(name, 0) + memory
+        cpu[name] = cpu.get(name, 0) + seconds
+
+    for name, memory in rss.items():
+        values['%s.rss' % name] = memory
+    for database, count in connections.items():
+        values['postgres.%s.connections' % database] = count
+    for bundle, queue in backlogs().items():
+        values['bundle.%s.backlog' % bundle] = queue
+    values.update(cpu_percent(cpu))
+    values.update(autoscalers())
+    return values
+
+
+def autoscalers():
+    """rq workers and queue lengths reported by the bundles' autoscalers"""
+    values = {}
+    pattern = os.path.join(BUNDLES, '*', 'run', 'autoscaler.json')
+    for path in glob.glob(pattern):
+        bundle = path.split(os.sep)[-3]
+        with open(path) as f:
+            status = json.load(f)
+        if time.time() - status['updated'] > 2 * INTERVAL:
+            continue  # Not running
+        values['bundle.%s.rq_workers' % bundle] = status['workers']
+        for queue, length in status['queues'].items():
+            values['bundle.%s.queue.%s' % (bundle, queue)] = length
+    return values
+
+
+def cpu_percent(cpu):
+    """
+    CPU usage since the previous sample from the cumulated CPU times. A
+    process that exits takes its CPU time with it, such drops are skipped.
+    """
+    now = time.time()
+    previous = {}
+    if os.path.exists(CPU_STATE):
+        with open(CPU_STATE) as f:
+            previous = json.load(f)
+    values = {}
+    for name, seconds in cpu.items():
+        if name in previous:
+            then, before = previous[name]
+            if seconds >= before and now > then:
+                values['%s.cpu' % name] = 100 * (seconds - before) / (
+                    now - then)
+    with open(CPU_STATE, 'w') as f:
+        json.dump(dict((name, (now, seconds))
+                       for name, seconds in cpu.items()), f)
+    return values
+
+
+def series_path(name):
+    return os.path.join(METRICS_DIR, re.sub(r'[^\w.-]', '_', name))
+
+
+def write(name, timestamp, value):
+    path = series_path(name)
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+        f.seek((timestamp // INTERVAL) % RETENTION * RECORD.size)
+        f.write(RECORD.pack(timestamp, value))
+
+
+def read(name, since=0):
+    """The (timestamp, value) records of a series since ``since``"""
+    with open(series_path(name), 'rb') as f:
+        data = f.read()
+    records = [RECORD.unpack_from(data, offset)
+               for offset in range(0, len(data) - RECORD.size + 1,
+                                   RECORD.size)]
+    return sorted(record for record in records if record[0] >= max(since, 1))
+
+
+def series():
+    if not os.path.isdir(METRICS_DIR):
+        return []
+    return sorted(name for name in os.listdir(METRICS_DIR)
+                  if not name.startswith('.'))
+
+
+def collect():
+    """Records a sample of every metric"""
+    if not os.path.isdir(METRICS_DIR):
+        os.makedirs(METRICS_DIR)
+    now = int(time.time())
+    for name, value in sample().items():
+        write(name, now, value)
+
+
+def query(name=None, hours=24):
+    """Lists the series, or prints the values of one of them"""
+    if name is None:
+        print('\n'.join(series()))
+        return
+    for timestamp, value in read(name, time.time() - float(hours) * 3600):
+        print('%s %.2f' % (datetime.datetime.fromtimestamp(
+            timestamp).isoformat(), value))
+
+
+def average(values):
+    return sum(values) / len(values)
+
+
+def trends():
+    """
+    Last value, average and maximum of each series over the last 24 hours,
+    compared to the average of the 24 hours before.
+    """
+    day = 24 * 3600
+    now = time.time()
+    lines = ['    %-40s %9s %9s %9s %9s' % ('Metric', 'Last', '24h avg',
+                                            '24h max', 'vs day-1')]
+    for name in series():
+        records = read(name, now - 2 * day)
+        today = [value for timestamp, value in records
+                 if timestamp >= now - day]
+        before = [value for timestamp, value in records
+                  if timestamp < now - day]
+        if not today:
+            continue
+        change = ''
+        if before and average(before):
+            change = '%+d%%' % ((average(today) / average(before) - 1) * 100)
+        lines.append('    %-40s %9.1f %9.1f %9.1f %9s' % (
+            name, today[-1], average(today), max(today), change))
+    return '\n'.join(lines)
+
+
+def redis_info():
+    """The fields of redis' INFO command"""
+    info = {}
+    for line in run('redis-cli info').splitlines():
+        if ':' in line and not line.startswith('#'):
+            name, value = line.strip().split(':', 1)
+            info[name] = value
+    return info
+
+
+def redis_report():
+    """Memory and evictions, and the keys of the DB of each bundle"""
+    info = redis_info()
+    if not info:
+        return '    redis is not running\n'
+    maxmemory = int(info.get('maxmemory', 0)) / MB
+    lines = ['    %.1fMB used of %s, %s policy, %s keys evicted since '
+             'startup' % (int(info.get('used_memory', 0)) / MB,
+                          '%dMB' % maxmemory if maxmemory else 'no limit',
+                          info.get('maxmemory_policy', '?'),
+                          info.get('evicted_keys', '?'))]
+    allocated = {}
+    if os.path.isdir(REDIS_DBS):
+        for bundle in os.listdir(REDIS_DBS):
+            if bundle.startswith('.'):
+                continue
+            with open(os.path.join(REDIS_DBS, bundle)) as f:
+                allocated.setdefault(int(f.read().strip()), []).append(bundle)
+    lines.append('')
+    lines.append('    %-4s %-40s %10s %10s' % ('DB', 'Bundles', 'Keys',
+                                              'Expiring'))
+    for db in sorted(set(allocated) | set(
+            int(name[2:]) for name in info if re.match(r'^db\d+$', name))):
+        # db3:keys=12,expires=10,avg_ttl=0
+        keyspace = dict(field.split('=', 1) for field in
+                        info.get('db%s' % db, 'keys=0,expires=0').split(','))
+        lines.append('    %-4s %-40s %10s %10s' % (
+            db, ', '.join(sorted(allocated.get(db, []))) or '-',
+            keyspace['keys'], keyspace['expires']))
+    return '\n'.join(lines) + '\n'
+
+
 def status_check():
     """
     Runs a series of checks and send some stats to the admins.
     """
-    run('apt-get update')
-
     disks = run('df -h|grep -E "^(/dev|File)"').replace("\n", "\n    ")
     disks = "    " + disks
 
     context = {
+        # From the package lists as of apt's last update, no network
         'packages': run('apt-get upgrade -sV | grep -E "^ "'),
+        'trends': trends(),
         'disks': disks,
         'uptime': run('uptime'),
+        'latency': run('%s --top 5' % LOGSTATS),
+        'redis': redis_report(),
     }
     message = EMAIL_TEMPLATE % context
 
@@ -60,6 +341,14 @@ EMAIL_TEMPLATE = """System status
 -------------
 
     %(uptime)s
+Trends
+------
+
+Memory in MB, CPU in %% of a core, backlog in waiting connections, queues
+in jobs.
+
+%(trends)s
+
 Disk space
 ----------
 
@@ -69,8 +358,21 @@ Mount points:
 Out-of-date packages
 --------------------
 
-%(packages)s"""
+%(packages)s
+Redis
+-----
+
+%(redis)s
+Response times
+--------------
+
+%(latency)s"""
 
 
 if __name__ == '__main__':
-    status_check()
+    if sys.argv[1:2] == ['collect']:
+        collect()
+    elif sys.argv[1:2] == ['query']:
+        query(*sys.argv[2:])
+    else:
+        status_check()
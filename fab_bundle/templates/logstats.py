@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency report from the bundles' access logs, in the timed_combined format.
+
+Logs are streamed, possibly gzipped, and latencies are kept in fixed-size
+sketches so memory doesn't grow with traffic. Without files, reads the logs
+of all the bundles for the given day (yesterday by default), including the
+ones rotated by logrotate.
+"""
+import argparse
+import datetime
+import glob
+import math
+import os
+import re
+import subprocess
+import sys
+
+BUNDLES = '{{ bundle_root or "/home/%s/bundles" % user }}'
+TOP = 10
+# Endpoints with fewer requests are left out of the slowest endpoints
+MIN_REQUESTS = 5
+# Beyond this number of URL patterns per bundle, new ones are counted as
+# "other"
+MAX_PATTERNS = 2000
+
+# Quantiles are within 1% of the actual values
+ACCURACY = 0.01
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 0.0005  # nginx logs times in ms, anything below is 0
+
+IDS = (
+    (re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                r'[0-9a-f]{12}$', re.I), ':uuid'),
+    (re.compile(r'^\d+$'), ':int'),
+    (re.compile(r'^[0-9a-f]{16,}$', re.I), ':hex'),
+    (re.compile(r'^[\w-]*\d[\w-]*\.\w+$'), ':file'),
+)
+
+
+class Sketch(object):
+    """
+    Streaming quantiles with a relative error bounded by ACCURACY: values
+    are counted in buckets whose bounds grow geometrically.
+    """
+    __slots__ = ('buckets', 'zeros', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < MIN_VALUE:
+            self.zeros += 1
+            return
+        key = int(math.ceil(math.log(value) / LOG_GAMMA))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * GAMMA ** key / (GAMMA + 1)
+        return 0.0
+
+
+class Endpoint(object):
+    __slots__ = ('latency', 'upstream')
+
+    def __init__(self):
+        self.latency = Sketch()
+        self.upstream = 0.0
+
+
+class Stats(object):
+    """Latencies of a bundle, overall, per status code and per endpoint"""
+
+    def __init__(self):
+        self.latency = Sketch()
+        self.statuses = {}
+        self.endpoints = {}
+        self.errors = 0
+
+    def add(self, method, pattern, status, total, upstream):
+        self.latency.add(total)
+        if status not in self.statuses:
+            self.statuses[status] = Sketch()
+        self.statuses[status].add(total)
+
+        key = (method, pattern)
+        if key not in self.endpoints:
+            if len(self.endpoints) >= MAX_PATTERNS:
+                key = (method, 'other')
+            self.endpoints.setdefault(key, Endpoint())
+        endpoint = self.endpoints[key]
+        endpoint.latency.add(total)
+        endpoint.upstream += upstream
+
+
+_patterns = {}
+
+
+def normalize(path):
+    """
+    URL pattern of a path: the query string is dropped and the segments that
+    look like identifiers are replaced, /users/42/ becoming /users/:int/.
+    """
+    if path in _patterns:
+        return _patterns[path]
+    segments = path.split('?', 1)[0].split('/')
+    for index, segment in enumerate(segments):
+        for regex, replacement in IDS:
+            if regex.match(segment):
+                segments[index] = replacement
+                break
+    pattern = '/'.join(segments)
+    if len(_patterns) > 100000:
+        _patterns.clear()
+    _patterns[path] = pattern
+    return pattern
+
+
+def parse(line):
+    """
+    Returns (day, method, path, status, request time, upstream time) for a
+    timed_combined log line, None if it can't be parsed.
+
+    Quoted fields are escaped by nginx, splitting on double quotes is
+    enough and much faster than a regex.
+    """
+    parts = line.split('"')
+    if len(parts) < 7:
+        return
+    try:
+        day = parts[0].split('[', 1)[1][:11]
+        method, path = parts[1].split(' ', 2)[:2]
+        status = parts[2].split(None, 1)[0]
+        times = parts[-1].split()
+        total = float(times[0])
+    except (IndexError, ValueError):
+        return
+    # Several upstream times are logged when nginx retried, as "0.1, 0.2"
+    upstream = 0.0
+    for value in times[1:-1]:
+        try:
+            upstream += float(value.rstrip(',:'))
+        except ValueError:
+            pass
+    return day, method, path, status, total, upstream
+
+
+def lines(path):
+    """Lines of a log file, decompressed by gzip in its own process"""
+    if not path.endswith('.gz'):
+        with open(path) as f:
+            for line in f:
+                yield line
+        return
+    process = subprocess.Popen(['gzip', '-dc', path], stdout=subprocess.PIPE)
+    try:
+        for line in process.stdout:
+            yield line
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def log_files(bundle, date):
+    """
+    The access logs of a bundle that may contain lines of ``date``: the
+    current one and the ones rotated since then (logrotate's dateext names
+    them after the day of the rotation).
+    """
+    logs = os.path.join(BUNDLES, bundle, 'log')
+    files = [os.path.join(logs, 'access.log')]
+    since = date.strftime('%Y%m%d')
+    for path in glob.glob(os.path.join(logs, 'access.log-*')):
+        rotated = os.path.basename(path)[len('access.log-'):][:8]
+        if rotated >= since:
+            files.append(path)
+    return [path for path in files if os.path.exists(path)]
+
+
+def analyze(files, date=None):
+    """Stats of the lines of ``date`` (all of them if None) in ``files``"""
+    stats = Stats()
+    day = date.strftime('%d/%b/%Y') if date else None
+    for path in files:
+        for line in lines(path):
+            parsed = parse(line)
+            if parsed is None:
+                stats.errors += 1
+                continue
+            if day is not None and parsed[0] != day:
+                continue
+            _, method, url, status, total, upstream = parsed
+            stats.add(method, normalize(url), status, total, upstream)
+    return stats
+
+
+def ms(seconds):
+    return '%dms' % round(seconds * 1000)
+
+
+def report(name, stats, top=TOP):
+    """Text report of a bundle's stats"""
+    latency = stats.latency
+    if not latency.count:
+        return '%s: no requests\n' % name
+    out = ['%s: %s requests, p50 %s, p95 %s, p99 %s' % (
+        name, latency.count, ms(latency.quantile(.5)),
+        ms(latency.quantile(.95)), ms(latency.quantile(.99)))]
+
+    out.append('')
+    out.append('    %-6s %8s %8s %8s %8s' % ('Status', 'Requests', 'p50',
+                                             'p95', 'p99'))
+    for status, sketch in sorted(stats.statuses.items()):
+        out.append('    %-6s %8s %8s %8s %8s' % (
+            status, sketch.count, ms(sketch.quantile(.5)),
+            ms(sketch.quantile(.95)), ms(sketch.quantile(.99))))
+
+    endpoints = [(endpoint.latency.quantile(.95), key, endpoint)
+                 for key, endpoint in stats.endpoints.items()
+                 if endpoint.latency.count >= MIN_REQUESTS]
+    endpoints.sort(reverse=True)
+    if endpoints:
+        out.append('')
+        out.append('    Slowest endpoints (p95), time spent in the app:')
+        for p95, (method, pattern), endpoint in endpoints[:top]:
+            sketch = endpoint.latency
+            share = endpoint.upstream / sketch.total if sketch.total else 0
+            out.append('    %8s %8s p50 %s p99 %s, %d%% upstream  %s %s' % (
+                ms(p95), sketch.count, ms(sketch.quantile(.5)),
+                ms(sketch.quantile(.99)), min(share, 1) * 100, method,
+                pattern))
+    if stats.errors:
+        out.append('')
+        out.append('    %s lines could not be parsed' % stats.errors)
+    return '\n'.join(out) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('files', nargs='*', help='access logs to analyze')
+    parser.add_argument('--date', help='YYYY-MM-DD, defaults to yesterday '
+                        'without files')
+    parser.add_argument('--top', type=int, default=TOP,
+                        help='number of slowest endpoints to show')
+    args = parser.parse_args()
+
+    date = None
+    if args.date:
+        date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    if args.files:
+        sys.stdout.write(report(', '.join(args.files),
+                                analyze(args.files, date), args.top))
+        return
+
+    date = date or datetime.date.today() - datetime.timedelta(days=1)
+    if not os.path.isdir(BUNDLES):
+        return
+    for bundle in sorted(os.listdir(BUNDLES)):
+        files = log_files(bundle, date)
+        if files:
+            sys.stdout.write(report(bundle, analyze(files, date), args.top))
+            sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/bin/bash
+# Gracefully reloads the gunicorn master of {{ http_host }} and waits until
+# its new workers answer on the bundle's socket.
+PIDFILE={{ bundle_root }}/run/gunicorn.pid
+SOCKET=/tmp/{{ http_host }}.sock
+PYTHON={{ bundle_root }}/current/env/bin/python
+TIMEOUT={{ reload_timeout or 60 }}
+
+START=$(date +%s%N)
+elapsed() {
+	echo $(( ($(date +%s%N) - START) / 1000000 ))
+}
+
+# Any HTTP response from the app will do, as long as it's not an error
+healthy() {
+	$PYTHON -c '
+import socket, sys
+s = socket.socket(socket.AF_UNIX)
+s.settimeout(5)
+s.connect(sys.argv[1])
+s.sendall(b"GET {{ health_check or "/" }} HTTP/1.0\r\nHost: {{ http_host }}\r\n\r\n")
+reply = b""
+while len(reply) < 12:
+    data = s.recv(12 - len(reply))
+    if not data:
+        break
+    reply += data
+ready = reply.startswith(b"HTTP/") and reply[9:10] in (b"1", b"2", b"3", b"4")
+sys.exit(0 if ready else 1)
+' $SOCKET 2>/dev/null
+}
+
+# Without a pidfile gunicorn has just been (re)started by supervisor and
+# there's nothing to reload.
+OLD=""
+if [ -e $PIDFILE ]; then
+	PID=$(cat $PIDFILE)
+	OLD=$(pgrep -P $PID)
+	kill -HUP $PID
+fi
+
+while [ $(elapsed) -lt $(( TIMEOUT * 1000 )) ]; do
+	RUNNING=""
+	for worker in $OLD; do
+		kill -0 $worker 2>/dev/null && RUNNING=yes
+	done
+	if [ -z "$RUNNING" ] && healthy; then
+		echo "ready in $(elapsed)ms"
+		exit 0
+	fi
+	sleep 0.2
+done
+
+echo "{{ http_host }} not ready after ${TIMEOUT}s"
+exit 1
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Syncs the static files collected (as symlinks) in SOURCE to TARGET, copying
+only the files whose content changed since the last run and writing their
+precompressed versions for nginx's gzip_static.
+
+Usage: static.py SOURCE TARGET MANIFEST
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.html', '.htm', '.txt', '.xml', '.json',
+                '.svg', '.ico', '.map', '.eot', '.ttf', '.otf')
+SUFFIXES = ('.gz', '.br')
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def walk(source):
+    """Maps the paths of the files in ``source``, relative to it, to their
+    checksums"""
+    files = {}
+    for directory, _, names in os.walk(source, followlinks=True):
+        for name in names:
+            path = os.path.join(directory, name)
+            files[os.path.relpath(path, source)] = checksum(path)
+    return files
+
+
+def write(path, data):
+    """Replaces a file atomically"""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def brotli_command():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['brotli', '--version'], stdout=devnull,
+                                  stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return 'brotli'
+
+
+def compress(path, has_brotli_command):
+    """
+    Writes the .gz (and .br if brotli is available) siblings of a file,
+    unless they wouldn't be smaller. Returns the number of files written.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    written = 0
+
+    tmp = path + '.gz.tmp'
+    with open(tmp, 'wb') as raw:
+        # No name nor timestamp, so that identical files compress identically
+        with gzip.GzipFile('', 'wb', 9, raw, mtime=0) as f:
+            f.write(data)
+    if os.path.getsize(tmp) < len(data):
+        os.rename(tmp, path + '.gz')
+        written += 1
+    else:
+        os.remove(tmp)
+        remove(path + '.gz')
+
+    if brotli is not None:
+        compressed = brotli.compress(data)
+        if len(compressed) < len(data):
+            write(path + '.br', compressed)
+            written += 1
+    elif has_brotli_command:
+        subprocess.check_call(['brotli', '-f', '-q', '11', '-o',
+                               path + '.br', path])
+        if os.path.getsize(path + '.br') >= len(data):
+            remove(path + '.br')
+        else:
+            written += 1
+    return written
+
+
+def remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def sync(source, target, manifest):
+    previous = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            previous = json.load(f)
+    current = walk(source)
+    has_brotli_command = brotli is None and brotli_command()
+
+    changed = removed = compressed = 0
+    for name, sha256 in sorted(current.items()):
+        path = os.path.join(target, name)
+        if previous.get(name) == sha256 and os.path.exists(path):
+            continue
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copyfile(os.path.join(source, name), path + '.tmp')
+        os.rename(path + '.tmp', path)
+        changed += 1
+        if name.lower().endswith(COMPRESSIBLE):
+            compressed += compress(path, has_brotli_command)
+
+    for name in set(previous) - set(current):
+        path = os.path.join(target, name)
+        for suffix in ('',) + SUFFIXES:
+            remove(path + suffix)
+        removed += 1
+
+    write(manifest, json.dumps(current, indent=2, sort_keys=True).encode())
+    print('%s files, %s changed, %s removed, %s compressed' % (
+        len(current), changed, removed, compressed))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit(__doc__.strip())
+    sync(*sys.argv[1:])
@@ -0,0 +1,277 @@
+"""
+Timing of the phases of a task and of the commands they run, exported as a
+timeline per host.
+
+``run``, ``sudo``, ``put``, ``get`` and ``local`` are drop-in replacements
+for Fabric's that record their duration, exit code and the bytes they
+transferred. Files go over one SFTP session per host (see transport.py), and
+commands whose output isn't needed can be sent together with ``pipeline()``.
+"""
+import json
+import os
+import re
+import time
+
+from contextlib import contextmanager
+
+from fabric import api
+from fabric.api import env
+from fabric.context_managers import settings
+
+from . import transport
+
+_timelines = {}
+_depth = {}
+_pipelines = {}
+
+# Out of the source tree, see artifacts.tree_checksum()
+TIMELINE_DIR = os.path.join('dist', 'timelines')
+
+# Spans that are a round trip to the host
+REMOTE = ('run', 'sudo', 'put', 'get')
+
+
+def current():
+    """The host being timed, None outside of ``fleet.on_hosts``"""
+    return env.get('timed_host')
+
+
+@contextmanager
+def span(name, kind, **details):
+    """Records the duration of the enclosed block"""
+    host = current()
+    entry = dict(details, name=name, kind=kind, start=time.time(),
+                 depth=_depth.get(host, 0))
+    _depth[host] = entry['depth'] + 1
+    try:
+        yield entry
+    except Exception as e:
+        entry['error'] = str(e).strip() or e.__class__.__name__
+        raise
+    finally:
+        _depth[host] -= 1
+        entry['duration'] = time.time() - entry['start']
+        _timelines.setdefault(host, []).append(entry)
+
+
+def phase(name):
+    """Times a phase of a task, phases can be nested"""
+    return span(name, 'phase')
+
+
+def size(path):
+    """Size of a local file or of a file-like object"""
+    if hasattr(path, 'getvalue'):
+        return len(path.getvalue())
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return 0
+
+
+class Pipeline(object):
+    """
+    Commands whose output isn't needed, sent in a single round trip before
+    the next command or transfer, or when the ``pipeline()`` block ends.
+    They run in order and stop at the first failure, like separate calls.
+    """
+    def __init__(self):
+        self.kind = None
+        self.commands = []
+
+    def run(self, command):
+        self.add('run', command)
+
+    def sudo(self, command):
+        self.add('sudo', command)
+
+    def add(self, kind, command):
+        if kind != self.kind:
+            self.flush()
+        self.kind = kind
+        # The block may be left before the commands are sent
+        if env.get('cwd'):
+            command = 'cd {0} && {1}'.format(env.cwd, command)
+        self.commands.append('({0})'.format(command))
+
+    def flush(self):
+        if not self.commands:
+            return
+        commands, self.commands = self.commands, []
+        func = api.run if self.kind == 'run' else api.sudo
+        with settings(cwd=''):
+            _command(func, self.kind, ' && '.join(commands),
+                     pipelined=len(commands))
+
+
+@contextmanager
+def pipeline():
+    """Queues the commands of the block in a ``Pipeline``"""
+    queued = _pipelines[current()] = Pipeline()
+    try:
+        yield queued
+        queued.flush()
+    finally:
+        _pipelines.pop(current(), None)
+
+
+def flush():
+    """Sends the commands queued for the current host, if any"""
+    queued = _pipelines.get(current())
+    if queued is not None:
+        queued.flush()
+
+
+def _command(func, kind, command, *args, **kwargs):
+    details = {'command': command}
+    if 'pipelined' in kwargs:
+        details['pipelined'] = kwargs.pop('pipelined')
+    elif kind != 'local':
+        flush()
+    with span(command[:80], kind, **details) as entry:
+        result = func(command, *args, **kwargs)
+        entry['exit_code'] = result.return_code
+        entry['bytes'] = len(result)
+    return result
+
+
+def run(command, *args, **kwargs):
+    return _command(api.run, 'run', command, *args, **kwargs)
+
+
+def sudo(command, *args, **kwargs):
+    return _command(api.sudo, 'sudo', command, *args, **kwargs)
+
+
+def local(command, *args, **kwargs):
+    return _command(api.local, 'local', command, *args, **kwargs)
+
+
+def put(local_path, remote_path, *args, **kwargs):
+    flush()
+    with span('put ' + remote_path, 'put',
+              command='put ' + remote_path) as entry:
+        uploaded = None
+        if not args:
+            uploaded = transport.upload(local_path, remote_path, **kwargs)
+        if uploaded is None:
+            result = api.put(local_path, remote_path, *args, **kwargs)
+        else:
+            result, move = uploaded
+            if move is not None:
+                # The upload is relative to home, whatever the cd()
+                with settings(cwd=''):
+                    api.sudo(move)
+                entry['round_trips'] = 2
+        entry['exit_code'] = 0 if result.succeeded else 1
+        entry['bytes'] = size(local_path)
+    return result
+
+
+def get(remote_path, local_path, *args, **kwargs):
+    flush()
+    with span('get ' + remote_path, 'get',
+              command='get ' + remote_path) as entry:
+        result = None
+        if not args:
+            result = transport.download(remote_path, local_path, **kwargs)
+        if result is None:
+            result = api.get(remote_path, local_path, *args, **kwargs)
+        entry['exit_code'] = 0 if result.succeeded else 1
+        entry['bytes'] = sum(size(path) for path in result)
+    return result
+
+
+def timeline():
+    """
+    The spans of the current host, preceded by the local ones (building the
+    package) that happened before the hosts were handled.
+    """
+    spans = _timelines.get(None, []) + _timelines.get(current(), [])
+    return sorted(spans, key=lambda entry: (entry['start'], entry['depth']))
+
+
+def chrome_trace(spans):
+    """Spans as trace events, for chrome://tracing or Perfetto"""
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 1,
+               'args': {'name': current() or 'local'}}]
+    for entry in spans:
+        events.append({
+            'name': entry['name'],
+            'cat': entry['kind'],
+            'ph': 'X',
+            'ts': int(entry['start'] * 1e6),
+            'dur': int(entry['duration'] * 1e6),
+            'pid': 1,
+            'tid': 1,
+            'args': dict((key, value) for key, value in entry.items()
+                         if key in ('command', 'exit_code', 'bytes',
+                                    'error', 'pipelined', 'round_trips')),
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def export(task_name):
+    """
+    Writes the timeline of the current host as JSON in ``env.timeline_dir``
+    (``dist/timelines`` by default), and as a Chrome trace next to it if
+    ``env.chrome_trace`` is set. Returns the path of the timeline.
+    """
+    spans = timeline()
+    if not spans:
+        return
+    directory = env.get('timeline_dir', TIMELINE_DIR)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    started = spans[0]['start']
+    base = os.path.join(directory, '{0}-{1}-{2}'.format(
+        task_name, re.sub(r'[^\w.-]', '_', current() or 'local'),
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(started))))
+
+    data = {
+        'task': task_name,
+        'host': current(),
+        'started': started,
+        'duration': max(entry['start'] + entry['duration']
+                        for entry in spans) - started,
+        'spans': [dict(entry, start=entry['start'] - started)
+                  for entry in spans],
+    }
+    with open(base + '.json', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    if env.get('chrome_trace'):
+        with open(base + '.trace.json', 'w') as f:
+            json.dump(chrome_trace(spans), f)
+    return base + '.json'
+
+
+def slowest(count=5):
+    """
+    The top-level phases and the ``count`` slowest commands of the current
+    host, as (name, duration) tuples.
+    """
+    spans = timeline()
+    phases = [(entry['name'], entry['duration']) for entry in spans
+              if entry['kind'] == 'phase' and entry['depth'] == 0]
+    commands = sorted([(entry['name'], entry['duration']) for entry in spans
+                       if entry['kind'] != 'phase'],
+                      key=lambda item: -item[1])
+    return phases, commands[:count]
+
+
+def round_trips():
+    """
+    The number of round trips to the current host, the number of commands
+    and transfers they carried and their total duration.
+    """
+    spans = [entry for entry in _timelines.get(current(), [])
+             if entry['kind'] in REMOTE]
+    return (sum(entry.get('round_trips', 1) for entry in spans),
+            sum(entry.get('pipelined', 1) for entry in spans),
+            sum(entry['duration'] for entry in spans))
+
+
+def reset():
+    """Forgets the spans of the current host once they've been exported"""
+    _timelines.pop(current(), None)
+    _depth.pop(current(), None)
+    _pipelines.pop(current(), None)
@@ -0,0 +1,93 @@
+"""
+File transfers over one SFTP session per host
+
+Fabric opens a new SFTP session for each put and get, on top of its cached
+SSH connection. Plain files and file-like objects are transferred over a
+session kept open for the whole task instead, Fabric's put and get handle
+the rest (globs, directories, modes).
+"""
+import hashlib
+import os
+import posixpath
+
+from fabric.api import env
+from fabric.state import connections
+
+_sessions = {}
+
+
+class Transferred(list):
+    """The transferred paths, like the result of Fabric's put and get"""
+    succeeded = True
+
+    def __init__(self, paths):
+        super(Transferred, self).__init__(paths)
+        self.failed = []
+
+
+def session():
+    """The SFTP session of the current host, opened on first use"""
+    sftp = _sessions.get(env.host_string)
+    if sftp is None or sftp.sock.closed:
+        sftp = connections[env.host_string].open_sftp()
+        _sessions[env.host_string] = sftp
+    return sftp
+
+
+def remote(path):
+    """Resolves ``path`` like Fabric: relative to home or to ``cd()``"""
+    if path.startswith('~/'):
+        path = path[2:]
+    if not posixpath.isabs(path) and env.get('cwd'):
+        path = posixpath.join(env.cwd, path)
+    return path
+
+
+def upload(local_path, remote_path, use_sudo=False, **kwargs):
+    """
+    Uploads a local file or a file-like object. With ``use_sudo`` it's
+    uploaded to the home directory first, like Fabric does, and the command
+    that moves it in place is returned. Returns (result, move command), or
+    None when Fabric's put should be used.
+    """
+    is_file = hasattr(local_path, 'read')
+    if kwargs or not (is_file or os.path.isfile(local_path)):
+        return
+    path = remote(remote_path)
+    target = path
+    if use_sudo:
+        target = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    sftp = session()
+    try:
+        if is_file:
+            local_path.seek(0)
+            sftp.putfo(local_path, target)
+        else:
+            sftp.put(local_path, target)
+    except IOError:  # A directory or a missing parent, Fabric's errors
+        return
+    move = 'mv "{0}" "{1}"'.format(target, path) if use_sudo else None
+    return Transferred([path]), move
+
+
+def download(remote_path, local_path, **kwargs):
+    """
+    Downloads a remote file to a local file path. Returns None when
+    Fabric's get should be used.
+    """
+    if (kwargs or not isinstance(local_path, basestring) or
+            '%(' in local_path or os.path.isdir(local_path) or
+            any(char in remote_path for char in '*?[')):
+        return
+    try:
+        session().get(remote(remote_path), local_path)
+    except IOError:
+        return
+    return Transferred([local_path])
+
+
+def close():
+    """Closes the SFTP session of the current host"""
+    sftp = _sessions.pop(env.host_string, None)
+    if sftp is not None:
+        sftp.close()
@@ -1,39 +1,56 @@
-import os
-import random
+import hashlib
 import re
-import string
 import sys
 import unicodedata
 
-from fabric.api import env, run, sudo, task
+from io import BytesIO
+
+from fabric.api import env, task
 from fabric.colors import red, green, blue
 from fabric.utils import abort
-from fabric.contrib.files import upload_template, exists
+
+from . import facts
+from .render import render
+from .timing import run, sudo, put
+
+
+def prefixed(msg):
+    """Prefixes messages with the current host when hosts run in parallel"""
+    if env.parallel and env.host_string:
+        return '[{0}] {1}'.format(env.host_string, msg)
+    return msg
 
 
 def fyi(msg):
     """Debug info"""
-    print >>sys.stderr, msg
+    print >>sys.stderr, prefixed(msg)
 
 
 def btw(msg):
     """Standard info"""
-    print >>sys.stderr, blue(msg)
+    print >>sys.stderr, blue(prefixed(msg))
 
 
 def yay(msg):
     """Success"""
-    print >>sys.stderr, green(msg)
+    print >>sys.stderr, green(prefixed(msg))
 
 
 def err(msg):
     """Error"""
-    print >>sys.stderr, red(msg, bold=True)
+    print >>sys.stderr, red(prefixed(msg), bold=True)
 
 
 def die(msg):
     """Serious error"""
-    abort(red(msg, bold=True))
+    abort(red(prefixed(msg), bold=True))
+
+
+def flag(value):
+    """A boolean task argument, Fabric passes them as strings"""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
 
 
 def slugify(value):
@@ -58,31 +75,23 @@ def template(source, destination, use_sudo=False):
     """
     Uploads a Jinja template with env as context, and returns True
     if the file has changed.
-    """
-    here = os.path.abspath(os.path.dirname(__file__))
-    template_dir = os.path.join(here, 'templates')
-
-    new_file = not exists(destination, use_sudo=use_sudo)
-
-    if not new_file:
-        chars = [random.choice(string.ascii_letters) for i in range(5)]
-        final_destination = destination
-        destination = '/tmp/%s' % "".join(chars)
-    upload_template(source, destination, context=env, backup=False,
-                    use_jinja=True, template_dir=template_dir,
-                    use_sudo=use_sudo)
-    if new_file:
-        return True
 
-    cmd = sudo if use_sudo else run
-    out = cmd('diff -u %s %s || true' % (final_destination, destination))
-    if out:
-        cmd('mv %s %s' % (destination, final_destination))
-        return True
-
-    assert destination.startswith('/tmp')
-    cmd('rm %s' % destination)
-    return False
+    The remote file is only replaced if its SHA-256 differs from the
+    rendered template's.
+    """
+    content = render(source)
+    digest = hashlib.sha256(content).hexdigest()
+
+    state = facts.current()
+    remote = state.checksum(destination)
+    if remote == '?' and use_sudo:
+        remote = sudo(facts.CHECKSUM.format(destination))
+    if remote == digest:
+        return False
+
+    put(BytesIO(content), destination, use_sudo=use_sudo)
+    state.update('sha256:' + destination, digest)
+    return True
 
 
 @task()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the command pipelining and SFTP transfers of timing.py and
+transport.py, against an in-process stand-in for Fabric: commands run in a
+local shell and files go to a temporary "home" directory.
+
+    python -m unittest discover -s tests
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+
+from contextlib import contextmanager
+from io import BytesIO
+
+
+class Env(dict):
+    """Fabric's env, a dict with attribute access"""
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+class Failed(Exception):
+    """What Fabric's abort raises in a task run by fleet.on_hosts"""
+
+
+class Result(str):
+    def __new__(cls, output, return_code=0):
+        result = str.__new__(cls, output)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = [] if result.succeeded else [output]
+        return result
+
+
+class Host(object):
+    """
+    The remote side: commands run in a local shell from ``home`` and every
+    call is recorded along with the ``cd()`` it was made in.
+    """
+    def __init__(self, home):
+        self.home = home
+        self.calls = []
+
+    def command(self, kind):
+        def call(command, *args, **kwargs):
+            self.calls.append((kind, command, env.get('cwd', '')))
+            if env.get('cwd'):
+                command = 'cd {0} && {1}'.format(env.cwd, command)
+            process = subprocess.Popen(['bash', '-c', command],
+                                       cwd=self.home, stdout=subprocess.PIPE)
+            output = process.communicate()[0].strip()
+            if process.returncode:
+                raise Failed(command)
+            return Result(output)
+        return call
+
+    def transfer(self, kind):
+        def call(*args, **kwargs):
+            self.calls.append((kind, args, kwargs))
+            return Result('', 0)
+        return call
+
+
+class SFTP(object):
+    """A paramiko SFTP client writing to the host's home"""
+    def __init__(self, host, broken=False):
+        self.host = host
+        self.broken = broken
+        self.sock = types.ModuleType('channel')
+        self.sock.closed = False
+
+    def path(self, remote_path):
+        if self.broken:
+            raise IOError(remote_path)
+        return os.path.join(self.host.home, remote_path)
+
+    def putfo(self, f, remote_path):
+        with open(self.path(remote_path), 'wb') as target:
+            target.write(f.read())
+        self.host.calls.append(('sftp put', remote_path, None))
+
+    def put(self, local_path, remote_path):
+        shutil.copy(local_path, self.path(remote_path))
+        self.host.calls.append(('sftp put', remote_path, None))
+
+    def get(self, remote_path, local_path):
+        shutil.copy(self.path(remote_path), local_path)
+        self.host.calls.append(('sftp get', remote_path, None))
+
+    def close(self):
+        self.sock.closed = True
+
+
+class Connection(object):
+    def __init__(self, host):
+        self.host = host
+        self.opened = 0
+        self.broken = False
+
+    def open_sftp(self):
+        self.opened += 1
+        return SFTP(self.host, self.broken)
+
+
+env = Env()
+
+
+@contextmanager
+def settings(**kwargs):
+    saved = dict(env)
+    env.update(kwargs)
+    try:
+        yield
+    finally:
+        env.clear()
+        env.update(saved)
+
+
+def cd(path):
+    return settings(cwd=path)
+
+
+# Stand-ins for the parts of Fabric timing.py and transport.py use, without
+# ``task`` so that fab_bundle/__init__.py skips the tasks.
+fabric = types.ModuleType('fabric')
+api = fabric.api = types.ModuleType('fabric.api')
+api.env = env
+context_managers = types.ModuleType('fabric.context_managers')
+context_managers.settings = settings
+state = types.ModuleType('fabric.state')
+state.connections = {}
+sys.modules.update({
+    'fabric': fabric,
+    'fabric.api': api,
+    'fabric.context_managers': context_managers,
+    'fabric.state': state,
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fab_bundle import timing, transport  # noqa
+
+
+class TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.home)
+        self.host = Host(self.home)
+        api.run = self.host.command('run')
+        api.sudo = self.host.command('sudo')
+        api.local = self.host.command('local')
+        api.put = self.host.transfer('fabric put')
+        api.get = self.host.transfer('fabric get')
+        self.connection = Connection(self.host)
+        state.connections.clear()
+        state.connections['example.com'] = self.connection
+        env.clear()
+        env.update(host_string='example.com', timed_host='example.com')
+        self.addCleanup(self.reset)
+
+    def reset(self):
+        timing.reset()
+        transport.close()
+
+    def calls(self, *kinds):
+        return [call[:2] for call in self.host.calls
+                if not kinds or call[0] in kinds]
+
+    def read(self, name):
+        with open(os.path.join(self.home, name)) as f:
+            return f.read()
+
+
+class PipelineTest(TransportTestCase):
+    def test_flushed_in_order_when_the_block_ends(self):
+        with timing.pipeline() as commands:
+            commands.run('echo 1 >> log')
+            commands.run('echo 2 >> log')
+            self.assertEqual(self.calls(), [])
+            commands.sudo('echo 3 >> log')
+            commands.sudo('echo 4 >> log')
+            # Switching from run to sudo sends the runs
+            self.assertEqual(self.calls(), [
+                ('run', '(echo 1 >> log) && (echo 2 >> log)'),
+            ])
+        self.assertEqual(self.calls(), [
+            ('run', '(echo 1 >> log) && (echo 2 >> log)'),
+            ('sudo', '(echo 3 >> log) && (echo 4 >> log)'),
+        ])
+        self.assertEqual(self.read('log').split(), ['1', '2', '3', '4'])
+
+    def test_cd(self):
+        os.mkdir(os.path.join(self.home, 'conf'))
+        with timing.pipeline() as commands:
+            commands.run('pwd > home')
+            with cd('conf'):
+                commands.run('pwd > conf')
+        # Sent outside of any cd(), each command keeps its own
+        self.assertEqual(self.host.calls, [
+            ('run', '(pwd > home) && (cd conf && pwd > conf)', ''),
+        ])
+        self.assertEqual(self.read('home').strip(),
+                         os.path.realpath(self.home))
+        self.assertEqual(self.read('conf/conf').strip(),
+                         os.path.realpath(os.path.join(self.home, 'conf')))
+
+    def test_flush_before_run(self):
+        with timing.pipeline() as commands:
+            commands.sudo('echo queued > log')
+            output = timing.run('cat log')
+        self.assertEqual(output, 'queued')
+        self.assertEqual(self.calls(), [
+            ('sudo', '(echo queued > log)'),
+            ('run', 'cat log'),
+        ])
+
+    def test_flush_before_put(self):
+        with timing.pipeline() as commands:
+            commands.run('echo queued')
+            timing.put(BytesIO(b'content'), 'file')
+        self.assertEqual(self.calls(), [
+            ('run', '(echo queued)'),
+            ('sftp put', 'file'),
+        ])
+
+    def test_flush_before_get(self):
+        local = os.path.join(self.home, 'local')
+        with timing.pipeline() as commands:
+            commands.run('echo content > remote')
+            timing.get('remote', local)
+        self.assertEqual(self.calls(), [
+            ('run', '(echo content > remote)'),
+            ('sftp get', 'remote'),
+        ])
+        with open(local) as f:
+            self.assertEqual(f.read(), 'content\n')
+
+    def test_stops_at_first_failure(self):
+        with self.assertRaises(Failed):
+            with timing.pipeline() as commands:
+                commands.run('echo 1 >> log')
+                commands.run('false')
+                commands.run('echo 3 >> log')
+        self.assertEqual(self.read('log').split(), ['1'])
+        failed = timing.timeline()[-1]
+        self.assertEqual(failed['pipelined'], 3)
+        self.assertIn('error', failed)
+
+    def test_not_sent_when_the_block_fails(self):
+        with self.assertRaises(ValueError):
+            with timing.pipeline() as commands:
+                commands.run('echo 1 >> log')
+                raise ValueError()
+        self.assertEqual(self.calls(), [])
+        timing.run('true')  # Nothing left queued
+        self.assertEqual(self.calls(), [('run', 'true')])
+
+
+class UploadTest(TransportTestCase):
+    def test_put(self):
+        result = timing.put(BytesIO(b'content'), 'file')
+        self.assertEqual(list(result), ['file'])
+        self.assertTrue(result.succeeded)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(self.read('file'), 'content')
+
+    def test_session_reused(self):
+        timing.put(BytesIO(b'1'), 'one')
+        timing.put(BytesIO(b'2'), 'two')
+        self.assertEqual(self.connection.opened, 1)
+        transport.close()
+        timing.put(BytesIO(b'3'), 'three')
+        self.assertEqual(self.connection.opened, 2)
+
+    def test_cd(self):
+        os.mkdir(os.path.join(self.home, 'conf'))
+        with cd('conf'):
+            result = timing.put(BytesIO(b'content'), 'file')
+        self.assertEqual(list(result), ['conf/file'])
+        self.assertEqual(self.read('conf/file'), 'content')
+
+    def test_sudo_put(self):
+        os.mkdir(os.path.join(self.home, 'etc'))
+        temporary = hashlib.sha1(b'etc/file').hexdigest()
+        with cd('etc'):
+            result = timing.put(BytesIO(b'content'), 'file', use_sudo=True)
+        self.assertEqual(list(result), ['etc/file'])
+        # Uploaded to home, then moved from there whatever the cd()
+        self.assertEqual(self.host.calls, [
+            ('sftp put', temporary, None),
+            ('sudo', 'mv "{0}" "etc/file"'.format(temporary), ''),
+        ])
+        self.assertEqual(self.read('etc/file'), 'content')
+        self.assertFalse(os.path.exists(os.path.join(self.home, temporary)))
+
+    def test_fabric_put(self):
+        source = BytesIO(b'content')
+        # Options transport.py doesn't handle
+        timing.put(source, 'file', mode=0o755)
+        # Errors are Fabric's to report, e.g. a missing parent
+        self.connection.broken = True
+        timing.put(source, 'missing/file', use_sudo=True)
+        self.assertEqual(self.host.calls, [
+            ('fabric put', (source, 'file'), {'mode': 0o755}),
+            ('fabric put', (source, 'missing/file'), {'use_sudo': True}),
+        ])
+
+    def test_fabric_get(self):
+        timing.get('log/*.log', self.home)
+        self.assertEqual(self.calls('fabric get', 'sftp get'), [
+            ('fabric get', ('log/*.log', self.home)),
+        ])
+
+    def test_results_are_not_shared(self):
+        first = transport.Transferred(['one'])
+        first.failed.append('one')
+        self.assertEqual(transport.Transferred(['two']).failed, [])
+
+
+class RoundTripsTest(TransportTestCase):
+    def test_counts(self):
+        self.assertEqual(timing.round_trips(), (0, 0, 0))
+        with timing.pipeline() as commands:
+            commands.run('true')
+            commands.run('true')
+            commands.run('true')
+        timing.put(BytesIO(b'content'), 'file', use_sudo=True)
+        timing.run('true')
+        timing.local('true')  # Not a round trip
+        trips, calls, duration = timing.round_trips()
+        # The pipeline, the upload and its mv, the run
+        self.assertEqual(trips, 4)
+        self.assertEqual(calls, 5)
+        self.assertTrue(duration > 0)
+
+    def test_phases_are_not_round_trips(self):
+        with timing.phase('config'):
+            timing.run('true')
+        self.assertEqual(timing.round_trips()[:2], (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()